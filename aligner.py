@@ -1,20 +1,49 @@
+import bisect
+import multiprocessing
 import os
+import re
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import timeit
 import json
 import argparse
 
+import stores
+
 
 
 # - - - Defaults - - -
 # Setting
 num_header_lines = 12
 output_full_alignment = True
+# How the alignment matrix is filled: 'banded' with array operations,
+# 'checkpointed' like banded but keeping only some of the rows (memory grows
+# with the square root of the text length, for book-length texts), 'full'
+# cell by cell (much slower), or 'auto' to choose by input size. All of them
+# give the same result. 'words' first matches up the words found once in
+# both texts and aligns only the text between them (with 'auto'), which is
+# fast for long texts of very different lengths but can differ slightly
+# around the matched words.
+alignment_engine = 'auto'
+# Largest banded matrix in bytes before 'auto' switches to checkpointed
+max_band_bytes = 1 << 30
+# Largest matrix in cells that 'auto' fills cell by cell
+max_full_cells = 25
+# Worker processes when aligning a whole corpus (also set with --processes)
+num_processes = 1
 
 # Outputs
 dir_full = 'train/parallelAligned/fullAlignments/'
 dir_misread = 'train/parallelAligned/misreads/'
 dir_misread_counts = 'train/parallelAligned/misreadCounts/'
+# Corpus mode: statistics of every file and of the whole corpus, and the
+# misread counts of all the files added up
+corpus_report = 'train/parallelAligned/corpus_report.txt'
+corpus_misread_counts = 'train/parallelAligned/corpus_misread_counts.txt'
+# SQLite store of the misread and character counts of every aligned file,
+# replaced file by file as they are aligned again ('' to skip). model_builder
+# reads it instead of the misread count files when its count_store is set.
+count_store = ''
 
 #-------------------------------------
 
@@ -42,42 +71,465 @@ def load_text(filename, header=0):
     return data
 
 
-def align(s1, s2, match=1, mismatch=-1, gap=-1, full_output=''):
+# The alignment matrix has a row for each character of s2 and a column for
+# each character of s1, plus the gap row and column. Only a band of width
+# 2k around the diagonal is filled in. Cells outside of it are read as 0,
+# with an empty pointer.
+def band_size(s1, s2):
+    n = len(s1) + 1
+    m = len(s2) + 1
+    # Approximation constant to limit and optimize matrix area; assumes a maximum misalignment distance of
+    # Ignoring this loop can give a more accurate results, yet computation time will become quadratic
+    return 2*abs(m-n)+20
+
+
+# Pointers of the banded matrix, by code
+pointer_codes = ['', 'D', 'H', 'V']
+
+
+# The stored width of a banded matrix, and whether it is stored in band
+# coordinates (shift 1) or in column coordinates (shift 0, when the band is
+# at least as wide as the matrix).
+def band_storage(s1, s2):
+    n = len(s1) + 1
+    k = band_size(s1, s2)
+    if 2*k < n:
+        return 2*k, 1
+    return n, 0
+
+
+# The memory used by a BandedMatrix: its int32 values and uint8 pointers,
+# and about 16 bytes per cell of a chunk while it is filled in.
+def band_bytes(s1, s2, chunk_cells=1 << 20):
+    m = len(s2) + 1
+    width, shift = band_storage(s1, s2)
+    chunk = min(m, max(1, chunk_cells // width)) * width
+    return m * (width + shift) * 4 + m * width + chunk * 16
+
+
+class BandedMatrix(object):
+    # Only the band, filled in a row at a time with array operations.
+    # values[i, c] and pointers[i, c] are the cell in row i and column
+    # j = c + shift * (i - k), so the cells above and above-left of a cell
+    # are at c+shift and c+shift-1 in the previous row. The rows are filled
+    # chunk_cells cells at a time, which bounds the memory used on top of
+    # the stored values and pointers.
+
+    def __init__(self, s1, s2, penalty, chunk_cells=1 << 20):
+        self.prepare(s1, s2, penalty, chunk_cells)
+        self.first_row = 0
+        self.values, self.pointers = self.fill(self.gap_row(), 1, self.m)
+
+    def prepare(self, s1, s2, penalty, chunk_cells):
+        self.n = n = len(s1) + 1
+        self.m = m = len(s2) + 1
+        self.k = k = band_size(s1, s2)
+        self.width, self.shift = width, shift = band_storage(s1, s2)
+        self.penalty = penalty
+        self.gap = penalty['GAP']
+        self.chunk_rows = max(1, chunk_cells // width)
+
+        # windows[i-1, c] is the character of s1 in the cell (i, c), to be
+        # compared with codes2[i-1]
+        codes1 = np.array([ord(c) for c in s1], dtype=np.int32)
+        self.codes2 = np.array([ord(c) for c in s2], dtype=np.int32)
+        if shift:
+            padded = np.concatenate((np.full(k + 1, -1, dtype=np.int32), codes1, np.full(width + 1, -1, dtype=np.int32)))
+            self.windows = as_strided(padded[1:], shape=(m - 1, width),
+                                      strides=(padded.strides[0], padded.strides[0]))
+        else:
+            padded = np.concatenate((np.full(1, -1, dtype=np.int32), codes1))
+            self.windows = as_strided(padded, shape=(m - 1, width),
+                                      strides=(0, padded.strides[0]))
+
+    def column(self, i, j):
+        return j - self.shift * (i - self.k)
+
+    def gap_row(self):
+        # In band coordinates, the extra last column is outside of the band,
+        # so it reads as 0, except in the gap row.
+        row = np.zeros(self.width + self.shift, dtype=np.int32)
+        start = self.column(0, 0)
+        row[start:] = self.gap * np.arange(len(row) - start)
+        return row
+
+    def band_columns(self, i):
+        # The stored columns of the band of row i, which is the columns
+        # max(i-k, 1) to min(i+k, n) - 1
+        offset = self.shift * (i - self.k)
+        return np.maximum(i - self.k, 1) - offset, np.minimum(i + self.k, self.n) - offset
+
+    def fill(self, prev, start, stop):
+        # The values and pointers of rows start to stop-1, computed from
+        # the values of row start-1 (prev), which is the first row of the
+        # values returned.
+        k, width, shift, gap = self.k, self.width, self.shift, self.gap
+        values = np.zeros((stop - start + 1, width + shift), dtype=np.int32)
+        values[0] = prev
+        pointers = np.zeros((stop - start + 1, width), dtype=np.uint8)
+        gaps = gap * np.arange(width, dtype=np.int32)
+        offsets = np.arange(width)
+
+        for chunk in xrange(start, stop, self.chunk_rows):
+            chunk_stop = min(chunk + self.chunk_rows, stop)
+            scores = np.where(self.windows[chunk-1:chunk_stop-1] == self.codes2[chunk-1:chunk_stop-1, np.newaxis],
+                              np.int32(self.penalty['MATCH']), np.int32(self.penalty['MISMATCH']))
+
+            for i in xrange(chunk, chunk_stop):
+                a, b = self.band_columns(i)
+                if a >= b:
+                    continue
+                prev = values[i-start]
+                best = np.maximum(prev[a+shift-1:b+shift-1] + scores[i-chunk, a:b], prev[a+shift:b+shift] + gap)
+                # The cell left of the band is the gap column, or outside of the band
+                if i <= k + 1:
+                    left = gap * i
+                else:
+                    left = 0
+                # Each cell is the best of its diagonal and vertical scores,
+                # or the cell to its left plus a gap. Going left t cells
+                # costs t gaps, so the row is a running maximum once the
+                # gaps are taken out.
+                row = values[i-start+1, a:b]
+                np.maximum.accumulate(best - gaps[:b-a], out=row)
+                np.maximum(row, left + gap, out=row)
+                row += gaps[:b-a]
+                # Column 0 is kept where it is stored, to be read by the
+                # next row
+                if i <= k + 1 and a > 0:
+                    values[i-start+1, a-1] = gap * i
+
+            # The pointers follow from the finished values. Ties are broken
+            # as in pointers(): D, then H, then V.
+            rows = np.arange(chunk, chunk_stop)
+            above = values[chunk-start:chunk_stop-start]
+            cur = values[chunk-start+1:chunk_stop-start+1, :width]
+            codes = np.full(cur.shape, 3, dtype=np.uint8)
+            ho = np.empty_like(cur)
+            ho[:, 1:] = cur[:, :-1]
+            if shift:
+                ho[:, 0] = np.where(rows == k + 1, gap * (k + 1), 0)
+            else:
+                ho[:, 0] = 0
+            ho += gap
+            codes[ho == cur] = 2
+            del ho
+            di = np.zeros_like(cur)
+            di[:, 1-shift:] = above[:, :width+shift-1]
+            di += scores
+            codes[di == cur] = 1
+            del di, scores
+            a, b = self.band_columns(rows)
+            codes[(offsets < a[:, np.newaxis]) | (offsets >= b[:, np.newaxis])] = 0
+            pointers[chunk-start+1:chunk_stop-start+1] = codes
+
+        return values, pointers
+
+    def in_band(self, i, j):
+        return max(i - self.k, 1) <= j < min(i + self.k, self.n)
+
+    def row_values(self, i):
+        return self.values[i - self.first_row]
+
+    def row_pointers(self, i):
+        return self.pointers[i - self.first_row]
+
+    def value(self, i, j):
+        if j == 0:
+            return self.gap * i
+        elif i == 0:
+            return self.gap * j
+        elif self.in_band(i, j):
+            return self.row_values(i)[self.column(i, j)]
+        return 0
+
+    def pointer(self, i, j):
+        if i == 0 and j == 0:
+            return '0'
+        elif j == 0:
+            return 'V'
+        elif i == 0:
+            return 'H'
+        elif self.in_band(i, j):
+            return pointer_codes[self.row_pointers(i)[self.column(i, j)]]
+        return ''
+
+
+class FullMatrix(BandedMatrix):
+    # The band filled in cell by cell, in the same storage as BandedMatrix.
+
+    def __init__(self, s1, s2, penalty):
+        self.prepare(s1, s2, penalty, 1)
+        k = self.k
+        self.first_row = 0
+        self.values = np.zeros((self.m, self.width + self.shift), dtype=np.int32)
+        self.values[0] = self.gap_row()
+        self.pointers = np.zeros((self.m, self.width), dtype=np.uint8)
+
+        for i in range(1, self.m):
+            for j in range(max([i-k,1]), min([i+k, self.n])):
+                di = self.value(i - 1, j - 1) + diagonal(s1[j - 1], s2[i - 1],
+                                                         penalty)  # The value for match/mismatch -  diagonal.
+                ho = self.value(i, j - 1) + penalty['GAP']  # The value for gap - horizontal.(from the left cell)
+                ve = self.value(i - 1, j) + penalty['GAP']  # The value for gap - vertical.(from the upper cell)
+                self.values[i, self.column(i, j)] = max(di, ho, ve)  # Fill the matrix with the maximal value.(based on the python default maximum)
+                self.pointers[i, self.column(i, j)] = pointer_codes.index(pointers(di, ho, ve))
+
+
+class CheckpointedMatrix(BandedMatrix):
+    # The band in linear memory: only every block_size-th row (about the
+    # square root of the number of rows by default) is kept. The backtrace
+    # moves up the matrix, so the rows of one block at a time are filled
+    # in again from the row above them when it reaches them.
+
+    def __init__(self, s1, s2, penalty, chunk_cells=1 << 20, block_size=None):
+        self.prepare(s1, s2, penalty, chunk_cells)
+        if block_size is None:
+            block_size = max(int(np.sqrt(self.m)), 1)
+        self.block_size = block_size
+
+        # checkpoints[b] is row b*block_size, the row above block b
+        self.checkpoints = [self.gap_row()]
+        for start in xrange(1, self.m, block_size):
+            values, _ = self.fill(self.checkpoints[-1], start, min(start + block_size, self.m))
+            self.checkpoints.append(values[-1])
+        self.first_row = None
+
+    def load_block(self, i):
+        # Rows (b-1)*block_size to b*block_size, the last one being row i,
+        # or the block of rows containing row i
+        b = (i - 1) // self.block_size
+        start = b*self.block_size + 1
+        self.values, self.pointers = self.fill(self.checkpoints[b], start,
+                                               min(start + self.block_size, self.m))
+        self.first_row = start - 1
+
+    def row_values(self, i):
+        if self.first_row is None or not self.first_row <= i < self.first_row + len(self.values):
+            self.load_block(i)
+        return self.values[i - self.first_row]
+
+    def row_pointers(self, i):
+        # The first row of a block only has its values
+        if self.first_row is None or not self.first_row < i < self.first_row + len(self.values):
+            self.load_block(i)
+        return self.pointers[i - self.first_row]
+
+
+# Words that occur exactly once in each text, as (start in s1, start in s2,
+# word), keeping the longest run of them in the same order in both texts.
+def anchor_words(s1, s2):
+    def unique_words(s):
+        positions = dict()
+        for match in re.finditer(r'\S+', s, re.UNICODE):
+            positions.setdefault(match.group(), []).append(match.start())
+        return dict((word, starts[0]) for word, starts in positions.iteritems() if len(starts) == 1)
+
+    words2 = unique_words(s2)
+    pairs = sorted((start, words2[word], word) for word, start in unique_words(s1).iteritems() if word in words2)
+
+    # Longest increasing subsequence of the positions in s2
+    tails = []
+    tail_index = []
+    previous = []
+    for index, (_, start2, _) in enumerate(pairs):
+        t = bisect.bisect_left(tails, start2)
+        if t == len(tails):
+            tails.append(start2)
+            tail_index.append(index)
+        else:
+            tails[t] = start2
+            tail_index[t] = index
+        previous.append(tail_index[t-1] if t > 0 else -1)
+    anchors = []
+    index = tail_index[-1] if tail_index else -1
+    while index >= 0:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+class WordAnchoredMatrix(object):
+    # Words found once in both texts are taken to be aligned to each other,
+    # and only the spans between them are aligned by character, each with
+    # its own (much smaller) matrix. The spans and the matched words make up
+    # a path through the whole matrix, with values that go up by the match
+    # score along the words, so the backtrace in align() follows it as it
+    # would the full matrix. Where the full alignment would not match the
+    # anchor words to each other, the errors around them can differ.
+
+    def __init__(self, s1, s2, penalty, engine='auto'):
+        # Span b covers rows rows[b] to row_ends[b] and columns columns[b]
+        # to column_ends[b]. Its last cell is followed by the matched
+        # characters of anchor b, which end on the first cell of span b+1.
+        self.rows = [0]
+        self.columns = [0]
+        self.row_ends = []
+        self.column_ends = []
+        # A first or last span with text on one side only can only be
+        # aligned as gaps at an end of the texts, which the backtrace
+        # cannot report, so the anchors next to it are dropped and those
+        # ends are left to the character alignment.
+        anchors = anchor_words(s1, s2)
+        while anchors and (len(s1) == anchors[-1][0] + len(anchors[-1][2])) != \
+                (len(s2) == anchors[-1][1] + len(anchors[-1][2])):
+            anchors.pop()
+        while anchors and (anchors[0][0] == 0) != (anchors[0][1] == 0):
+            anchors.pop(0)
+        for start1, start2, word in anchors:
+            self.row_ends.append(start2)
+            self.column_ends.append(start1)
+            self.rows.append(start2 + len(word))
+            self.columns.append(start1 + len(word))
+        self.row_ends.append(len(s2))
+        self.column_ends.append(len(s1))
+        self.match = penalty['MATCH']
+
+        # Values in span b are its own matrix's plus bases[b]
+        self.matrices = []
+        self.bases = []
+        base = 0
+        for b in xrange(len(self.rows)):
+            span1 = s1[self.columns[b]:self.column_ends[b]]
+            span2 = s2[self.rows[b]:self.row_ends[b]]
+            if engine == 'auto':
+                matrix = alignment_engines[choose_engine(span1, span2)](span1, span2, penalty)
+            else:
+                matrix = alignment_engines[engine](span1, span2, penalty)
+            self.matrices.append(matrix)
+            self.bases.append(base)
+            base += matrix.value(len(span2), len(span1))
+            if b + 1 < len(self.rows):
+                base += self.match * (self.rows[b+1] - self.row_ends[b])
+        self.last_span = 0
+
+    # The span or anchor word of a cell, as ('span', b, row, column) in the
+    # span's own matrix, ('anchor', b, t) for the t-th character of anchor b,
+    # or None off the path.
+    def locate(self, i, j):
+        # The backtrace reads cells in order, so the last span is tried first
+        b = self.last_span
+        if not (b == 0 or self.row_ends[b-1] < i) or not i <= self.row_ends[b]:
+            b = self.last_span = bisect.bisect_left(self.row_ends, i)
+        if b < len(self.rows) and i >= self.rows[b] and self.columns[b] <= j <= self.column_ends[b] and \
+                (b == 0 or i != self.rows[b] or j != self.columns[b]):
+            return ('span', b, i - self.rows[b], j - self.columns[b])
+        if b > 0:
+            t = i - self.row_ends[b-1]
+            if t == j - self.column_ends[b-1] and 0 < t <= self.rows[b] - self.row_ends[b-1]:
+                return ('anchor', b - 1, t)
+        return None
+
+    def value(self, i, j):
+        cell = self.locate(i, j)
+        if cell is None:
+            return 0
+        elif cell[0] == 'span':
+            _, b, row, column = cell
+            return self.bases[b] + self.matrices[b].value(row, column)
+        _, b, t = cell
+        return self.bases[b] + self.matrices[b].value(self.row_ends[b] - self.rows[b],
+                                                       self.column_ends[b] - self.columns[b]) + self.match * t
+
+    def pointer(self, i, j):
+        cell = self.locate(i, j)
+        if cell is None:
+            return ''
+        elif cell[0] == 'span':
+            _, b, row, column = cell
+            return self.matrices[b].pointer(row, column)
+        return 'D'
+
+
+alignment_engines = {'full':FullMatrix, 'banded':BandedMatrix, 'checkpointed':CheckpointedMatrix,
+                     'words':WordAnchoredMatrix}
+
+
+# The engine used for 'auto': the full matrix for tiny inputs, where array
+# operations cost more than they save, the band while its values and
+# pointers, and the memory used to fill them, fit in max_band_bytes, and
+# checkpoints beyond that.
+def choose_engine(s1, s2):
+    n = len(s1) + 1
+    m = len(s2) + 1
+    if n * m <= max_full_cells:
+        return 'full'
+    if band_bytes(s1, s2) <= max_band_bytes:
+        return 'banded'
+    return 'checkpointed'
+
+
+class Alignment(object):
+    # The result of align(): the errors as [correct, incorrect, word index,
+    # word index2] (word indices are -1 for a single space), the full
+    # alignment as (correct, incorrect) pairs in text order, and the count
+    # of each character of the corrected text.
+
+    def __init__(self, errors, full_alignment, char_counts):
+        self.errors = errors
+        self.full_alignment = full_alignment
+        self.char_counts = char_counts
+
+    def write_errors(self, filename):
+        with open(filename, 'wb') as f:
+            json.dump(self.errors, f)
+
+    def write_full_alignment(self, filename):
+        with open(filename, 'wb') as f:
+            json.dump(self.full_alignment, f)
+
+    # Number of words with exactly one error and with more than one
+    def word_error_counts(self):
+        seen = []
+        marked = []
+        for _,_,index,_ in self.errors:
+            if index == -1: pass
+            elif not index in seen:
+                seen.append(index)
+            elif index in seen and not index in marked:
+                marked.append(index)
+        return len(seen) - len(marked), len(marked)
+
+    # The occurrences of each error, and of each misread character being
+    # read correctly, to calculate probabilities later
+    def misread_counts(self):
+        misreadCountDictionary = {}
+        for char, mistake, _, _ in self.errors:
+            if char in misreadCountDictionary:
+                if mistake in misreadCountDictionary[char]:
+                    misreadCountDictionary[char][mistake] += 1
+                else:
+                    misreadCountDictionary[char][mistake] = 1
+            else:
+                misreadCountDictionary[char] = {mistake : 1}
+
+        # Add counts of correct chars to the dictionary
+        for char in misreadCountDictionary:
+            if len(char) == 1:
+                total = sum(misreadCountDictionary[char].values())
+                misreadCountDictionary[char][char] = self.char_counts[char] - total
+        return misreadCountDictionary
+
+
+def align(s1, s2, match=1, mismatch=-1, gap=-1, engine='auto'):
     penalty = {'MATCH': match, 'MISMATCH': mismatch, 'GAP': gap}  # Penalty dictionary
     n = len(s1) + 1  # # matrix columns
     m = len(s2) + 1  # # matrix rows
-    al_mat = np.zeros((m, n), dtype=int)  # Initializes the alignment matrix with zeros
-    p_mat = np.zeros((m, n), dtype=str)  # Initializes the alignment matrix with zeros
-    # Scans all the first rows element in the matrix and fill it with "gap penalty"
-    for i in range(m):
-        al_mat[i][0] = penalty['GAP'] * i
-        p_mat[i][0] = 'V'
-    # Scans all the first columns element in the matrix and fill it with "gap penalty"
-    for j in range(n):
-        al_mat[0][j] = penalty['GAP'] * j
-        p_mat[0][j] = 'H'
-    # Fill the matrix with the correct values.
-
-    # Approximation constant to limit and optimize matrix area; assumes a maximum misalignment distance of
-    # Ignoring this loop can give a more accurate results, yet computation time will become quadratic
-    k = 2*abs(m-n)+20
-    for i in range(1, m):
-        for j in range(max([i-k,1]), min([i+k, n])):
-            al_mat[i][j] = -k
-
-    p_mat[0][0] = 0  # Return the first element of the pointer matrix back to 0.
-    for i in range(1, m):
-        for j in range(max([i-k,1]), min([i+k, n])):#range(1,n):#
-            di = al_mat[i - 1][j - 1] + diagonal(s1[j - 1], s2[i - 1],
-                                                 penalty)  # The value for match/mismatch -  diagonal.
-            ho = al_mat[i][j - 1] + penalty['GAP']  # The value for gap - horizontal.(from the left cell)
-            ve = al_mat[i - 1][j] + penalty['GAP']  # The value for gap - vertical.(from the upper cell)
-            al_mat[i][j] = max(di, ho, ve)  # Fill the matrix with the maximal value.(based on the python default maximum)
-            p_mat[i][j] = pointers(di, ho, ve)
+    # All engines give the same matrix in the band
+    if engine == 'auto':
+        engine = choose_engine(s1, s2)
+    matrix = alignment_engines[engine](s1, s2, penalty)
+    al_mat = matrix.value
+    p_mat = matrix.pointer
 
     #helper indexer functions for word statistics
     def getWordIndex(index):
         a = index
+        # Text inserted after the end of s1 belongs to its last word, as in
+        # getWordIndex2
+        if a >= len(s1):
+            a = len(s1) - 1
         while a >= 0 and not s1[a].isspace():
             a -= 1
         # Fix a bug occuring when the final character of s1 is whitespace
@@ -103,9 +555,9 @@ def align(s1, s2, match=1, mismatch=-1, gap=-1, full_output=''):
     
     
     while i != 0 and j != 0:
-        val = p_mat[j][i]
+        val = p_mat(j, i)
 
-        if val == 'D' and al_mat[j-1][i-1] <= al_mat[j][i]: # if match
+        if val == 'D' and al_mat(j-1, i-1) <= al_mat(j, i): # if match
             i -= 1
             j -= 1
             
@@ -114,8 +566,8 @@ def align(s1, s2, match=1, mismatch=-1, gap=-1, full_output=''):
         else: #there is a discrepancy
             correctString = ''
             incorrectString = ''
-            while (i != 0 and j != 0) and not (val == 'D' and al_mat[j-1][i-1] <= al_mat[j][i]):
-                if val == 'D' and not al_mat[j-1][i-1] <= al_mat[j][i]: #mistmach
+            while (i != 0 and j != 0) and not (val == 'D' and al_mat(j-1, i-1) <= al_mat(j, i)):
+                if val == 'D' and not al_mat(j-1, i-1) <= al_mat(j, i): #mistmach
                     i -= 1
                     j -= 1
                     correctString = s1[i] + correctString
@@ -129,7 +581,7 @@ def align(s1, s2, match=1, mismatch=-1, gap=-1, full_output=''):
                 else:
                     break
                 #update value
-                val = p_mat[j][i]
+                val = p_mat(j, i)
             wordIndex = -1
             wordIndex2 = -1
             
@@ -141,101 +593,166 @@ def align(s1, s2, match=1, mismatch=-1, gap=-1, full_output=''):
             fullAlign.append((correctString, incorrectString))
             
 
-    if full_output != '':
-        fullAlign.reverse()
-        with open(full_output, 'wb') as f:
-            json.dump(fullAlign, f)
-            
+    fullAlign.reverse()
     # format: [[correct, incorrect, word index, word index2],...]
     errors.reverse()
-    return errors
 
+    correctCharCountDict = {}
+    for char in s1:
+        if char in correctCharCountDict:
+            correctCharCountDict[char] += 1
+        else:
+            correctCharCountDict[char] = 1
+    return Alignment(errors, fullAlign, correctCharCountDict)
 
-#-------------------------------------
 
-if __name__=='__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('original_file', help='original version of file')
-    parser.add_argument('gold_file', help='corrected version of file')
-    
-    args = parser.parse_args()
+# Align an original file with its gold file and write the misreads, the
+# full alignment and the misread counts. Returns the file's statistics and
+# misread counts.
+def align_files(original_file, gold_file):
+    basename = os.path.splitext(os.path.basename(original_file))[0]
     
-    wordCount = 0
-    singleErrorWordCount = 0
-    multipleErrorWordCount = 0
-    charCount = 0
-    errorCharCount = 0
-    correctCharCountDict = {}
-    
-    basename = os.path.splitext(os.path.basename(args.original_file))[0]
-    print 'Comparing files...'
-    print args.original_file, '\n', args.gold_file
-    
-    #Run
-    start = timeit.default_timer()
-    
-    correctedText = ''.join(load_text(args.gold_file, num_header_lines))
-    originalText = ''.join(load_text(args.original_file, num_header_lines))
+    correctedText = ''.join(load_text(gold_file, num_header_lines))
+    originalText = ''.join(load_text(original_file, num_header_lines))
     
+    alignment = align(correctedText, originalText, engine=alignment_engine)
+
     # Output full alignments or just misread counts and misread indices
     if output_full_alignment == True:
-        full_path = os.path.join(dir_full, basename + '_full_alignment.txt')
-        newErrors = align(correctedText, originalText, full_output=full_path)
-    
-    newErrors = align(correctedText, originalText)
+        alignment.write_full_alignment(os.path.join(dir_full, basename + '_full_alignment.txt'))
     
     # Output the indices of misread characters
-    with open(os.path.join(dir_misread, basename + '_misreads.txt'), 'wb') as f:
-        json.dump(newErrors, f)
-        
-    charCount += len(''.join(correctedText.split()))
-    errorCharCount += len(newErrors)
+    alignment.write_errors(os.path.join(dir_misread, basename + '_misreads.txt'))
 
     # Get error word counts
-    wordCount += len(correctedText.split())
-    seen = []
-    marked = []
-
-    for _,_,index,_ in newErrors:
-        if index == -1: pass
-        elif not index in seen:
-            seen.append(index)
-        elif index in seen and not index in marked:
-            marked.append(index)
-    multipleErrorWordCount += len(marked)
-    singleErrorWordCount += len(seen) - len(marked)
-    
-    #Get correct char counts
-    for char in correctedText:
-        if char in correctCharCountDict:
-            correctCharCountDict[char] += 1
-        else:
-            correctCharCountDict[char] = 1
+    singleErrorWordCount, multipleErrorWordCount = alignment.word_error_counts()
 
-    print 'Characters with error', errorCharCount / float(charCount) * 100 
-    print 'Words with one error:', singleErrorWordCount/ float(wordCount) * 100
-    print 'Words with multiple errors:', multipleErrorWordCount/ float(wordCount) * 100 
-    
-    # Count the occurrences of errors, to calculate probabilities later
-    misreadCountDictionary = {}
-    for char, mistake, _, _ in newErrors:
-        if char in misreadCountDictionary:
-            if mistake in misreadCountDictionary[char]:
-                misreadCountDictionary[char][mistake] += 1
-            else:
-                misreadCountDictionary[char][mistake] = 1
-        else:
-            misreadCountDictionary[char] = {mistake : 1}
-    
-    # Add counts of correct chars to the dictionary
-    for char in misreadCountDictionary:
-        if len(char) == 1:
-            total = sum(misreadCountDictionary[char].values())
-            misreadCountDictionary[char][char] = correctCharCountDict[char] - total
-    
     # Output the misread counts. These will be used to build the HMM    
+    misreadCountDictionary = alignment.misread_counts()
     with open(os.path.join(dir_misread_counts, basename + '_misread_counts.txt'), 'wb') as f:
         json.dump(misreadCountDictionary, f)
+
+    if count_store != '':
+        initials, transitions = word_counts(correctedText)
+        stores.CountStore(count_store).update(basename, misreadCountDictionary, alignment.char_counts,
+                                               initials, transitions)
+
+    stats = {'chars': len(''.join(correctedText.split())), 'error_chars': len(alignment.errors),
+             'words': len(correctedText.split()),
+             'single_error_words': singleErrorWordCount, 'multiple_error_words': multipleErrorWordCount}
+    return stats, misreadCountDictionary
+
+
+# How often each character starts a word, and how often each character is
+# followed by each other one within a word.
+def word_counts(text):
+    initials = {}
+    transitions = {}
+    for word in text.split():
+        initials[word[0]] = initials.get(word[0], 0) + 1
+        for i in xrange(len(word)-1):
+            following = transitions.setdefault(word[i], {})
+            following[word[i+1]] = following.get(word[i+1], 0) + 1
+    return initials, transitions
+
+
+# Percentages of characters with errors and of words with one or more
+# errors.
+def error_rates(stats):
+    return {'char_error_rate': stats['error_chars'] / float(max(stats['chars'], 1)) * 100,
+            'single_error_word_rate': stats['single_error_words'] / float(max(stats['words'], 1)) * 100,
+            'multiple_error_word_rate': stats['multiple_error_words'] / float(max(stats['words'], 1)) * 100}
+
+
+def print_error_rates(stats):
+    rates = error_rates(stats)
+    print 'Characters with error', rates['char_error_rate']
+    print 'Words with one error:', rates['single_error_word_rate']
+    print 'Words with multiple errors:', rates['multiple_error_word_rate']
+
+
+# Pairs of original and gold files in two directories, the gold file of
+# original/name.txt being c_name.txt.
+def corpus_files(original_dir, gold_dir):
+    pairs = []
+    for filename in sorted(os.listdir(original_dir)):
+        gold_file = os.path.join(gold_dir, 'c_' + filename)
+        if os.path.isfile(gold_file):
+            pairs.append((os.path.join(original_dir, filename), gold_file))
+        else:
+            print 'No gold file for', filename
+    return pairs
+
+
+def _align_pair(pair):
+    return pair, align_files(*pair)
+
+
+# Align every pair of files, with a pool of worker processes if there is
+# more than one, and write the corpus report and the misread counts of the
+# whole corpus.
+def align_corpus(pairs, processes=1):
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_align_pair, pairs)
+    else:
+        pool = None
+        results = (_align_pair(pair) for pair in pairs)
+
+    report = {'files': {}}
+    totals = dict.fromkeys(['chars', 'error_chars', 'words', 'single_error_words', 'multiple_error_words'], 0)
+    misreadCounts = {}
+    for (original_file, _), (stats, misreadCountDictionary) in results:
+        basename = os.path.splitext(os.path.basename(original_file))[0]
+        stats.update(error_rates(stats))
+        report['files'][basename] = stats
+        print basename, 'characters with error', stats['char_error_rate']
+        for key in totals:
+            totals[key] += stats[key]
+        for char, mistakes in misreadCountDictionary.iteritems():
+            counts = misreadCounts.setdefault(char, {})
+            for mistake, count in mistakes.iteritems():
+                counts[mistake] = counts.get(mistake, 0) + count
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    totals['files'] = len(report['files'])
+    totals.update(error_rates(totals))
+    report['corpus'] = totals
+    with open(corpus_report, 'wb') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    with open(corpus_misread_counts, 'wb') as f:
+        json.dump(misreadCounts, f)
+    return totals
+
+
+#-------------------------------------
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('original_file', help='original version of file, or directory of original files')
+    parser.add_argument('gold_file', help='corrected version of file, or directory of corrected files (named c_ + original name)')
+    parser.add_argument('--processes', type=int, default=num_processes,
+                        help='number of worker processes when aligning directories')
+    
+    args = parser.parse_args()
+    
+    #Run
+    start = timeit.default_timer()
+
+    if os.path.isdir(args.original_file):
+        pairs = corpus_files(args.original_file, args.gold_file)
+        print 'Aligning {} pairs of files...'.format(len(pairs))
+        totals = align_corpus(pairs, args.processes)
+        print '\nCorpus of {} files'.format(totals['files'])
+        print_error_rates(totals)
+    else:
+        print 'Comparing files...'
+        print args.original_file, '\n', args.gold_file
+        stats, _ = align_files(args.original_file, args.gold_file)
+        print_error_rates(stats)
     
     stop = timeit.default_timer()
     print '\nCompleted in', stop - start, 'seconds.'
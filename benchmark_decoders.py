@@ -0,0 +1,57 @@
+import argparse
+import time
+
+import decoder
+import decoding_script
+
+
+
+# - - - Defaults - - -
+# Settings
+num_header_lines = 12
+kn = 4
+use_log_probabilities = False
+
+# Inputs
+hmm_params = 'resources/hmm_parameters.txt'
+dir_original = 'original/'
+
+#-------------------------------------
+
+# Decode every distinct token with the given function, returning the
+# decodings and the time taken.
+def run(decode, words, k):
+    start = time.time()
+    decodings = [decode(word, k) for word in words]
+    return decodings, time.time() - start
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Compare the beam and exact k-best decoders')
+    parser.add_argument('input_file', nargs='?', default=dir_original,
+                        help='text file or directory of text files to decode')
+    parser.add_argument('--hmm', default=hmm_params, help='HMM parameters')
+    parser.add_argument('-k', type=int, default=kn, help='number of decodings per token')
+
+    args = parser.parse_args()
+
+    words = set()
+    for filename in decoding_script.input_files(args.input_file):
+        words.update(word for word in decoder.iter_text(filename, num_header_lines)
+                     if word != '\n' and word != '\r')
+    words = sorted(words)
+    hmm = decoder.load_hmm(args.hmm, use_log_probabilities)
+    print 'Decoding {} types with k = {}'.format(len(words), args.k)
+
+    beam, beam_time = run(hmm.k_best_beam, words, args.k)
+    exact, exact_time = run(hmm.k_best_exact, words, args.k)
+    for name, elapsed in (('beam', beam_time), ('exact', exact_time)):
+        print '{:>6}: {:.2f} s ({:.0f} types/s)'.format(name, elapsed, len(words) / max(elapsed, 1e-9))
+
+    # The beam can only miss paths, so its scores are never higher.
+    same_list = sum(1 for b, e in zip(beam, exact) if b == e)
+    same_scores = sum(1 for b, e in zip(beam, exact) if [x[1] for x in b] == [x[1] for x in e])
+    same_best = sum(1 for b, e in zip(beam, exact) if b[0][1] == e[0][1])
+    print 'Same k-best list:       {} of {} types'.format(same_list, len(words))
+    print 'Same k-best scores:     {} of {} types'.format(same_scores, len(words))
+    print 'Same best score:        {} of {} types'.format(same_best, len(words))
@@ -0,0 +1,17 @@
+import argparse
+
+import decoder
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Convert a decodings CSV file to the columnar format')
+    parser.add_argument('csv_file', help='decodings written by decoding_script.py')
+    parser.add_argument('binary_file', help='output file')
+    parser.add_argument('-k', type=int, default=4, help='number of decoded candidates in input')
+    parser.add_argument('--words', type=int, default=1,
+                        help='number of word columns before the candidates (2 with a gold column, as read by tune.py)')
+
+    args = parser.parse_args()
+
+    decoder.convert_decodings(args.csv_file, args.binary_file, args.k, args.words)
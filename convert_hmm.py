@@ -0,0 +1,14 @@
+import argparse
+
+import decoder
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Convert JSON HMM parameters to the binary format')
+    parser.add_argument('json_file', help='HMM parameters written by model_builder.py')
+    parser.add_argument('binary_file', help='output file')
+
+    args = parser.parse_args()
+
+    decoder.convert_hmm(args.json_file, args.binary_file)
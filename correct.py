@@ -40,6 +40,10 @@ dehyphtk = True
 
 # naming convention for HMM decoding files
 decodeext = '_decoded.csv'
+decodebinext = '_decoded.bin'
+
+# read the columnar decodings written by decoding_script.py instead of the CSV
+columnar = False
 
 # decision code conversion dictionary
 conv = {'o':'ORIG','a':'ANNOT','k':'K1','d':'KDICT'}
@@ -68,6 +72,7 @@ parser.add_argument("-t", help="file to track annotations")
 parser.add_argument("-m", help="file of memorised deterministic corrections")
 parser.add_argument("-p", help="original plain text corpus directory location")
 parser.add_argument("-l", help="number of header lines in original corpus texts")
+parser.add_argument("-b", help="read columnar decodings (_decoded.bin) instead of the CSV, y/n (default n)")
 
 
 # - - - parse inputs - - -
@@ -139,6 +144,17 @@ if args.m:
 if args.l:
     print("Lines of metadata: " + args.l)
     nheaderlines = int(args.l)
+if args.b:
+    if args.b in ['y','Y','yes','Yes']:
+        columnar = True
+    elif args.b in ['n','N','no','No']:
+        columnar = False
+    else:
+        print("uninterpretable columnar specification!  : " + '"' + args.b + '"')
+        exit()
+# Only the columnar format needs the decoder module (and numpy)
+if columnar:
+    import decoder
 if args.o:
     correctfilename = args.o
 else:
@@ -148,7 +164,10 @@ if args.w:
 else:
     dictpotentialname = dictadddir + fileid + '.txt'
 origfilename = origtxtdir + fileid + '.txt'
-decodefilename = decodecsvdir + fileid + decodeext
+if columnar:
+    decodefilename = decodecsvdir + fileid + decodebinext
+else:
+    decodefilename = decodecsvdir + fileid + decodeext
 
 # don't write over finished corrections
 if os.path.isfile(correctfilename):
@@ -254,6 +273,19 @@ def basicDictCheck(wd):
         return False
 
 
+# - - -
+# punctuation stripping
+# - - - 
+
+# forms already stripped of punctuation - filled in advance from columnar decodings
+stripcache = {}
+
+def stripp(wd):
+    if wd not in stripcache:
+        stripcache[wd] = regex.sub(ur"\p{P}+", "", wd)
+    return stripcache[wd]
+
+
 # - - -
 # hyphenation
 # - - - 
@@ -262,36 +294,36 @@ def basicDictCheck(wd):
 def dehyph(tk):
     o = tk
     # if - in token, and token is not only punctuation, and - is not at end or start of token:
-    if (u'-' in tk) & ((len(regex.sub(ur"\p{P}+", "", tk)) > 0) & ((tk[-1] != u'-') & (tk[0] != u'-')) ):
+    if (u'-' in tk) & ((len(stripp(tk)) > 0) & ((tk[-1] != u'-') & (tk[0] != u'-')) ):
         # if - doesn't precede capital letter, and the word including dash form isn't in dictionary:
         if ((not tk[tk.index(u'-')+1].isupper()) & ((not tk in dws) & (not tk.lower() in dws))):
             # if the word not including dash form is in dictionary, only then take out the dash
-            if (( regex.sub(ur"\p{P}+", "", tk) in dws) or (  regex.sub(ur"\p{P}+", "", tk).lower() in dws)):
+            if (( stripp(tk) in dws) or (  stripp(tk).lower() in dws)):
                 o = tk.replace(u'-',u'')
     return(o)
 
 
 # try putting together some lines that were split by hyphenation - preprocessing step
+# lines are lists of fields
 def linecombiner(ls):
     for i in range(len(ls) - 2):
-        if (ls[i] != u'BLANK'):
-            curw = ls[i].split('\t')[0]
-            newl = ls[i+1].split('\t')[0]
-            nexw = ls[i+2].split('\t')[0]
+        if (ls[i] is not None):
+            curw = ls[i][0]
+            newl = ls[i+1][0]
+            nexw = ls[i+2][0]
             # look for pattern: wordstart-, newline, restofword.
             
             if (((newl == u'_NEWLINE_N_') or (newl == u'_NEWLINE_R_')) & ((curw[-1] == u'-') & (len(curw) > 1)) ):
 # check that: wordstart isn't in dictionary,
 # combining it with restofword is in dictionary,
 # and restofword doesn't start with capital letter -- this is generally approximately good enough
-                if ( ((not(checcy(regex.sub(ur"\p{P}+", "", curw)))) & (checcy(regex.sub(ur"\p{P}+", "", curw+nexw)))) & (nexw[0].islower())):
+                if ( ((not(checcy(stripp(curw)))) & (checcy(stripp(curw+nexw)))) & (nexw[0].islower())):
 # make a new row to put combined form into the output later
-                    newrw = (u'\t').join([curw[:-1]+nexw,curw[:-1]+nexw,curw[:-1]+nexw,u'.99',u'_PRE_COMBINED_',u'1.11e-25',u'_PRE_COMBINED_',u'1.11e-25',u'_PRE_COMBINED_',u'1.11e-25'])
-                    newrw += u'\r\n'
+                    newrw = [curw[:-1]+nexw,curw[:-1]+nexw,curw[:-1]+nexw,u'.99',u'_PRE_COMBINED_',u'1.11e-25',u'_PRE_COMBINED_',u'1.11e-25',u'_PRE_COMBINED_',u'1.11e-25']
                     ls[i] = newrw
-                    ls[i+1] = u'BLANK'
-                    ls[i+2] = u'BLANK'
-    return [lin for lin in ls if lin != u'BLANK']
+                    ls[i+1] = None
+                    ls[i+2] = None
+    return [lin for lin in ls if lin is not None]
 
 
 # - - -
@@ -303,7 +335,7 @@ def linecombiner(ls):
 def fetchcontext(n,dec,tokenlist):
     lbound = max((n - 15),0)
     ubound = min((n + 15),len(dec))
-    return (tokenlist[lbound:n], [ln.split('\t')[0] for ln in dec[(n+1):ubound]])
+    return (tokenlist[lbound:n], [ln[0] for ln in dec[(n+1):ubound]])
 
 
 
@@ -314,13 +346,13 @@ def fetchcontext(n,dec,tokenlist):
 # // --------------------- //
 
 
-def codeline(i,ln):
+# l is the list of the token's fields
+def codeline(i,l):
 
 # - - -
 
     # setup
     decision = 'UNK'
-    l = ln.replace(u'\r\n','').split('\t')
 
 # - - -
 
@@ -342,10 +374,10 @@ def codeline(i,ln):
  # punctuation is considered not relevant
     
     # original form
-    orig = regex.sub(ur"\p{P}+", "", l[0])
+    orig = stripp(l[0])
 
     # k best candidate words
-    kbws = [ regex.sub(ur"\p{P}+", "", l[ix]) for ix in range(1,(kn*2),2)]
+    kbws = [ stripp(l[ix]) for ix in range(1,(kn*2),2)]
 
     # top k best
     k1 = kbws[0]
@@ -473,10 +505,15 @@ for l in mtd:
     o.write(l.replace(u'Corrected: No',u'Corrected: Yes'))
 
 
-# get decodings to use for correction
-decf = codecs.open(decodefilename, 'r', 'utf-8')
-dec = decf.readlines()[1:]
-decf.close()
+# get decodings to use for correction, split into fields
+if columnar:
+    decs = decoder.load_decodings_binary(decodefilename)
+    stripcache.update(decs.stripped_forms())
+    dec = list(decs.rows())[1:]
+else:
+    decf = codecs.open(decodefilename, 'r', 'utf-8')
+    dec = [l.replace(u'\r\n','').split('\t') for l in decf.readlines()[1:]]
+    decf.close()
 
 
 if linecombine:
@@ -507,7 +544,7 @@ for (i, lin) in enumerate(dec):
         tokenlist.append(handle[1][1])
         trackdict[u'\t'.join([handle[1][0],handle[1][1]])] += 1
     elif 'ERROR' in handle[0]:
-        print('\n\n' + handle[0] + ': That should not have happened!\nLine print:\n'+ u' # '.join(lin.split(u'\t')) )
+        print('\n\n' + handle[0] + ': That should not have happened!\nLine print:\n'+ u' # '.join([unicode(x) for x in lin]) )
 
     elif handle[0] == 'ANNOT':
         huct +=1 # increment human-effort count
@@ -1,15 +1,29 @@
+import array
+import collections
 import csv
 import json
-import cStringIO
-import codecs
 import re
 import itertools
+import math
+import operator
+import hashlib
+import heapq
+import struct
+import sys
+import unicodedata
+
+import numpy as np
+
+import stores
 
 
 
 class Decoder(object):
 
-    def __init__(self, hmm, word_dict, prev_decodings=None):
+    def __init__(self, hmm, word_dict, prev_decodings=None,
+                 linear_probabilities=True, lexicon=None, lexicon_width=20,
+                 multichar_engine='variants', lattice_width=None, engine='beam',
+                 fast_path=None):
         self.hmm = hmm
         self.word_dict = word_dict
         if prev_decodings is None:
@@ -17,26 +31,91 @@ class Decoder(object):
         else:
             self.prev_decodings = prev_decodings
 
+        # Output scores as linear probabilities even if the HMM
+        # works in log space.
+        self.linear_probabilities = linear_probabilities
+        self.log_output = hmm.log_space and not linear_probabilities
+
+        # Optional LexiconTrie. If none of the k-best decodings is in the
+        # dictionary, the best in-lexicon decoding takes the last place.
+        # It is searched with a beam lexicon_width paths wide, which can
+        # miss the best word, or exactly if lexicon_width is None.
+        self.lexicon = lexicon
+        self.lexicon_width = lexicon_width
+
+        # How multi-character errors are tried: 'variants' decodes every
+        # combination of substitutions separately, 'lattice' decodes them
+        # all in a single pass over a lattice of the alternatives.
+        if multichar_engine not in ('variants', 'lattice'):
+            raise ValueError('Unknown multichar engine: {}'.format(multichar_engine))
+        self.multichar_engine = multichar_engine
+        self.lattice_width = lattice_width
+
+        # How the k-best decodings of a word are found: 'beam' keeps the k
+        # best paths at each step, 'exact' finds the true k best paths.
+        # The multichar lattice is always searched with a beam.
+        if engine not in ('beam', 'exact'):
+            raise ValueError('Unknown decoding engine: {}'.format(engine))
+        self.engine = engine
+
+        # If set, words that pass the dictionary check and whose characters
+        # are all emitted by their own state with at least this probability
+        # are decoded as themselves, without a search. The other k-1
+        # decodings are left empty.
+        self.fast_path = fast_path
+
 
-    def decode_word(self, word, k, multichars={}):
+    def k_best(self, word, k):
+        if self.engine == 'exact':
+            return self.hmm.k_best_exact(word, k)
+        return self.hmm.k_best_beam(word, k)
+
+
+    def decode_word(self, word, k, multichars={}, k_best=None):
+        # k_best may be given if the beam search for the word has already
+        # been done, as by decode_words.
         if len(word) == 0:
-            return [''] + ['',0.0] * k
+            return [''] + ['', float('-inf') if self.log_output else 0.0] * k
 
-        if word in self.prev_decodings:
-            return [word] + self.prev_decodings[word]
+        prev = self.prev_decodings.get(word)
+        if prev is not None:
+            return [word] + list(prev)
 
-        k_best = self.hmm.k_best_beam(word, k)
+        if k_best is None and self.fast_path is not None and self.in_dictionary(word):
+            score = self.hmm.identity_score(word, self.fast_path)
+            if score is not None:
+                impossible = float('-inf') if self.hmm.log_space else 0.0
+                k_best = [(word, score)] + [('', impossible)] * (k - 1)
+                self.hmm.stats['fast_path_words'] += 1
+        if k_best is None:
+            k_best = self.k_best(word, k)
         # Check for common multi-character errors. If any are present,
         # make substitutions and compare probabilties of decoder results.
         for sub in multichars:
             # Only perform the substitution if none of the k-best decodings are present in the dictionary
             if sub in word and all(self.strip_punctuation(x[0]) not in self.word_dict for x in k_best):
-                variant_words = self.multichar_variants(word, sub, multichars[sub])
-                for v in variant_words:
-                    if v != word:
-                        k_best.extend(self.hmm.k_best_beam(v, k))
+                if self.multichar_engine == 'lattice':
+                    sites = [(m.start(), m.end(), replacement)
+                             for m in re.finditer(re.escape(sub), word)
+                             for replacement in multichars[sub]]
+                    # The lattice also covers the unchanged word
+                    k_best.extend(x for x in self.hmm.k_best_lattice(word, k, sites, self.lattice_width)
+                                  if x not in k_best)
+                else:
+                    variant_words = self.multichar_variants(word, sub, multichars[sub])
+                    for v in variant_words:
+                        if v != word:
+                            k_best.extend(self.k_best(v, k))
                 # Keep the k best 
                 k_best = sorted(k_best, key=lambda x: x[1], reverse=True)[:k]
+
+        if self.lexicon is not None and all(self.strip_punctuation(x[0]) not in self.word_dict for x in k_best):
+            in_lexicon = self.hmm.k_best_lexicon(word, 1, self.lexicon, self.lexicon_width)
+            if len(in_lexicon) > 0 and in_lexicon[0] not in k_best:
+                k_best = sorted(k_best[:k-1] + in_lexicon, key=lambda x: x[1], reverse=True)
+
+        if self.hmm.log_space and self.linear_probabilities:
+            k_best = [(seq, math.exp(score)) for seq, score in k_best]
                    
         k_best = [element for subsequence in k_best for element in subsequence]
         self.prev_decodings[word] = k_best
@@ -44,6 +123,41 @@ class Decoder(object):
         return [word] + k_best
 
 
+    def decode_words(self, words, k, multichars={}):
+        # Decode several words, returning a dict of decode_word results.
+        # The beam searches are done together so that words sharing a
+        # prefix share its decoding.
+        new_words = [word for word in set(words) if word not in self.prev_decodings]
+        if self.fast_path is not None:
+            new_words = [word for word in new_words if not self.in_dictionary(word)]
+        if self.engine == 'beam':
+            k_bests = self.hmm.k_best_beam_batch(new_words, k)
+        else:
+            k_bests = dict()
+        return {word:self.decode_word(word, k, multichars, k_bests.get(word))
+                for word in set(words)}
+
+
+    def fingerprint(self, k, multichars={}):
+        # Identifies the decodings this decoder produces for a given k
+        # and set of multichar errors.
+        if self.lexicon is not None:
+            lexicon = [self.lexicon.fingerprint(), self.lexicon_width]
+        else:
+            lexicon = None
+        # The dictionary decides which words are tried with multichar
+        # errors and which take the fast path, so adding words to it
+        # changes the decodings.
+        dictionary = hashlib.sha1(json.dumps(sorted(self.word_dict))).hexdigest()
+        # A floor of 0 gives the same decodings as no emission floor.
+        config = json.dumps([self.hmm.fingerprint(), k, multichars, self.multichar_engine,
+                             self.lattice_width, self.linear_probabilities, lexicon,
+                             self.hmm.emission_floor or None, self.hmm.prune_ratio,
+                             self.hmm.beam_budget, self.engine, self.fast_path, dictionary],
+                            sort_keys=True)
+        return hashlib.sha1(config).hexdigest()
+
+
     def multichar_variants(self, word, original, replacements):
         variants = [original] + replacements
         variant_words = set()
@@ -57,6 +171,18 @@ class Decoder(object):
         return variant_words
 
 
+    def in_dictionary(self, word):
+        # The asymmetric case check of tune.py and correct.py: a word
+        # passes as it is, or when capitalised if the dictionary has it in
+        # lower case, after stripping punctuation.
+        word = self.strip_punctuation(word)
+        if word in self.word_dict:
+            return True
+        elif len(word) == 0:
+            return False
+        return word[0] != word[0].lower() and word.lower() in self.word_dict
+
+
     def strip_punctuation(self, word):
         # Everything from string.punctuation
         punctuation = re.escape('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~')
@@ -67,149 +193,1120 @@ class Decoder(object):
 
 class HMM(object):
 
-    def __init__(self, initial, transition, emission):
+    def __init__(self, initial, transition, emission, log_space=False):
         self.init = initial
         self.tran = transition
         self.emis = emission
-        
-        self.states = initial.keys()
-        self.symbols = emission[self.states[0]].keys()
+
+        states = initial.keys()
+        symbols = emission[states[0]].keys()
+
+        # Dense copies of the parameters, indexed by position in
+        # states and symbols.
+        self._set_tables(states, symbols,
+                         np.array([initial[i] for i in states]),
+                         np.array([[transition[i][j] for j in states] for i in states]),
+                         np.array([[emission[i][c] for c in symbols] for i in states]),
+                         log_space)
+
+
+    @classmethod
+    def from_arrays(cls, states, symbols, init, tran, emis, log_space=False):
+        # Create an HMM directly from dense tables, e.g. memory-mapped from
+        # a binary model file. The init, tran and emis dicts are not built.
+        hmm = cls.__new__(cls)
+        hmm.init = hmm.tran = hmm.emis = None
+        hmm._set_tables(states, symbols, init, tran, emis, log_space)
+        return hmm
+
+
+    def _set_tables(self, states, symbols, init, tran, emis, log_space):
+        self.states = states
+        self.symbols = symbols
+        # Counts of the work done by the decoding methods
+        self.stats = collections.Counter()
+
+        self.state_ids = {s:i for i, s in enumerate(states)}
+        self.symbol_ids = {c:i for i, c in enumerate(symbols)}
+        self.init_array = init
+        self.tran_array = tran
+        self.emis_array = emis
+
+        # In log space the dense tables hold log probabilities and path
+        # scores are summed rather than multiplied, so that long words do
+        # not underflow to 0.0. Zero probabilities become -inf.
+        self.log_space = log_space
+        if log_space:
+            with np.errstate(divide='ignore'):
+                self.init_array = np.log(self.init_array)
+                self.tran_array = np.log(self.tran_array)
+                self.emis_array = np.log(self.emis_array)
+            self.combine = operator.add
+        else:
+            self.combine = operator.mul
+
+        # No emission sparsity index until set_emission_floor is called
+        self.emission_floor = None
+        self.emitting_states = None
+        # Nor any pruning until set_pruning is called
+        self.prune_ratio = None
+        self.beam_budget = None
+        self.prune_audit = False
+
+
+    def set_emission_floor(self, floor):
+        # For each symbol, the states (in order) whose emission probability
+        # is above floor. Beam steps only extend paths with these states,
+        # which is exact with a floor of 0, as every other candidate scores
+        # 0. None turns the index off again.
+        self.emission_floor = floor
+        if floor is None:
+            self.emitting_states = None
+            return
+        if self.log_space:
+            with np.errstate(divide='ignore'):
+                floor = np.log(floor)
+        self.emitting_states = [np.flatnonzero(self.emis_array[:, c] > floor)
+                                for c in xrange(len(self.symbols))]
+
+
+    def set_pruning(self, ratio=None, budget=None, audit=False):
+        # Beam paths scoring below ratio times the best path of the beam
+        # are not extended any further. Once budget paths have been
+        # extended for a token, only its best path is extended. The final
+        # step still keeps k paths. With audit, every pruned decoding is
+        # compared with the exact beam, counting the tokens whose k-best
+        # list changed in stats['pruning_changed'].
+        self.prune_ratio = ratio
+        self.beam_budget = budget
+        self.prune_audit = audit
+
+
+    def fingerprint(self):
+        # A hash of the model parameters, which changes whenever the
+        # model is rebuilt with different counts.
+        h = hashlib.sha1()
+        h.update(json.dumps([self.states, self.symbols, self.log_space]))
+        for table in (self.init_array, self.tran_array, self.emis_array):
+            h.update(np.ascontiguousarray(table, dtype='<f8').tostring())
+        return h.hexdigest()
 
 
     def viterbi(self, char_seq):
-        # delta[t][j] is probability of max probability path to state j
-        # at time t given the observation sequence up to time t.
-        delta = [None] * len(char_seq)
-        back_pointers = [None] * len(char_seq)
-
-        delta[0] = {i:self.init[i] * self.emis[i][char_seq[0]]
-                    for i in self.states}
-
-        for t in xrange(1, len(char_seq)):
-            # (preceding state with max probability, value of max probability)           
-            d = {j:max({i:delta[t-1][i] * self.tran[i][j] for i in self.states}.iteritems(),
-                       key=lambda x: x[1]) for j in self.states}
-            
-            delta[t] = {i:d[i][1] * self.emis[i][char_seq[t]] for i in self.states}
-            
-            back_pointers[t] = {i:d[i][0] for i in self.states}
+        return self.viterbi_batch([char_seq])[0]
 
-        best_state = max(delta[-1], key=lambda x: delta[-1][x])
 
-        selected_states = [best_state] * len(char_seq)
-        for t in xrange(len(char_seq) - 1, 0, -1):
-            best_state = back_pointers[t][best_state]
-            selected_states[t-1] = best_state
+    def viterbi_batch(self, words, batch_size=256):
+        # Decode the most probable state sequence for each word. Words of
+        # the same length are decoded together, batch_size at a time, with
+        # delta[t, b, j] the score of the best path to state j at time t
+        # for word b and back_pointers[t, b, j] its preceding state.
+        decodings = [None] * len(words)
+        by_length = collections.defaultdict(list)
+        for index, word in enumerate(words):
+            by_length[len(word)].append(index)
 
-        return ''.join(selected_states)
+        combine = self.combine
+        n = len(self.states)
+        for length, indices in by_length.iteritems():
+            if length == 0:
+                for index in indices:
+                    decodings[index] = ''
+                continue
+
+            for start in xrange(0, len(indices), batch_size):
+                batch = indices[start:start + batch_size]
+                obs = np.array([[self.symbol_ids[c] for c in words[index]]
+                                for index in batch])
+
+                delta = np.empty((length, len(batch), n))
+                back_pointers = np.zeros((length, len(batch), n), dtype=int)
+
+                delta[0] = combine(self.init_array, self.emis_array[:, obs[:, 0]].T)
+                for t in xrange(1, length):
+                    # scores[b, i, j] is the best path to i extended to j.
+                    scores = combine(delta[t-1][:, :, np.newaxis], self.tran_array)
+                    back_pointers[t] = scores.argmax(axis=1)
+                    delta[t] = combine(scores.max(axis=1),
+                                       self.emis_array[:, obs[:, t]].T)
+
+                rows = np.arange(len(batch))
+                selected_states = np.empty((len(batch), length), dtype=int)
+                selected_states[:, -1] = delta[-1].argmax(axis=1)
+                for t in xrange(length - 1, 0, -1):
+                    selected_states[:, t-1] = back_pointers[t, rows, selected_states[:, t]]
+
+                for index, seq in zip(batch, selected_states):
+                    decodings[index] = ''.join([self.states[i] for i in seq])
+
+        return decodings
 
 
     def k_best_beam(self, word, k):
-        # Single symbol input is just initial * emission.
-        if len(word) == 1:
-            paths = [(i, self.init[i] * self.emis[i][word[0]])
-                     for i in self.states]
-            paths = sorted(paths, key=lambda x: x[1], reverse=True)
+        symbols = [self.symbol_ids[c] for c in word]
+
+        beam = self._beam_start(symbols[0])
+        for t in xrange(1, len(word)):
+            beam = self._beam_step(beam, symbols[t], k)
+        self.stats['beam_steps'] += len(word)
+
+        result = self._beam_result(beam, k)
+        if self.prune_audit:
+            self._audit_pruning(word, k, result)
+        return result
+
+
+    def k_best_beam_batch(self, words, k):
+        # The k_best_beam results for many words, as a dict. The words are
+        # sorted, and the beam after each prefix of the previous word is
+        # kept, so a prefix shared by several words is only decoded once.
+        results = dict()
+        beams = []
+        previous = ''
+        for word in sorted(set(words)):
+            if len(word) == 0:
+                continue
+
+            shared = 0
+            while shared < min(len(word), len(beams)) and word[shared] == previous[shared]:
+                shared += 1
+            del beams[shared:]
+
+            for t in xrange(shared, len(word)):
+                symbol = self.symbol_ids[word[t]]
+                if t == 0:
+                    beams.append(self._beam_start(symbol))
+                else:
+                    beams.append(self._beam_step(beams[-1], symbol, k))
+            self.stats['beam_steps'] += len(word) - shared
+            self.stats['beam_steps_saved'] += shared
+
+            results[word] = self._beam_result(beams[-1], k)
+            if self.prune_audit:
+                self._audit_pruning(word, k, results[word])
+            previous = word
+
+        return results
+
+
+    def _audit_pruning(self, word, k, result):
+        # Decode the word again without pruning, leaving the stats as
+        # they were apart from the audit counts.
+        if self.prune_ratio is None and self.beam_budget is None:
+            return
+        stats = self.stats.copy()
+        pruning = self.prune_ratio, self.beam_budget
+        self.prune_ratio, self.beam_budget = None, None
+        try:
+            exact = self.k_best_beam(word, k)
+        finally:
+            self.prune_ratio, self.beam_budget = pruning
+            self.stats = stats
+        self.stats['audited_tokens'] += 1
+        if exact != result:
+            self.stats['pruning_changed'] += 1
+
+
+    def identity_score(self, word, floor=0.0):
+        # The score of the path decoding each character as itself, or None
+        # if a character is not a hidden state or is emitted by its own
+        # state with a probability below floor.
+        if any(c not in self.state_ids or c not in self.symbol_ids for c in word):
+            return None
+        states = [self.state_ids[c] for c in word]
+        emis = self.emis_array[states, [self.symbol_ids[c] for c in word]]
+        if self.log_space:
+            with np.errstate(divide='ignore'):
+                floor = np.log(floor)
+        if len(word) == 0 or emis.min() < floor:
+            return None
+        score = self.combine(self.init_array[states[0]], emis[0])
+        for t in xrange(1, len(word)):
+            score = self.combine(self.combine(score, self.tran_array[states[t-1], states[t]]), emis[t])
+        return float(score)
+
+
+    def k_best_exact(self, word, k):
+        # The k most probable state sequences, found exactly with the
+        # recursive enumeration algorithm of Jimenez and Marzal. A Viterbi
+        # pass gives the best path to each state at each time step. The
+        # next best paths to a state are only found when a later path
+        # needs them, from a heap of candidates: the best paths to each
+        # preceding state not used yet, extended to this one.
+        combine = self.combine
+        symbols = [self.symbol_ids[c] for c in word]
+        n = len(self.states)
+
+        delta = np.empty((len(word), n))
+        delta[0] = combine(self.init_array, self.emis_array[:, symbols[0]])
+        viterbi_back = np.zeros((len(word), n), dtype=int)
+        for t in xrange(1, len(word)):
+            scores = combine(delta[t-1][:, np.newaxis], self.tran_array)
+            viterbi_back[t] = scores.argmax(axis=0)
+            delta[t] = combine(scores.max(axis=0), self.emis_array[:, symbols[t]])
+
+        # paths[t][j] lists the paths to state j at time t found so far,
+        # best first, as (score, preceding state, rank of the path to it).
+        paths = [[[(delta[t, j], viterbi_back[t, j], 0)] for j in xrange(n)]
+                 for t in xrange(len(word))]
+        heaps = [[None] * n for _ in word]
+
+        def find_path(t, j, rank):
+            # Find the paths to (t, j) up to the given rank. False if there
+            # are not that many. Each path needs the next path to its
+            # preceding state, so the requests are kept on a stack as
+            # [t, j, rank, path at t-1 waited for] rather than recursing
+            # once per time step.
+            stack = [[t, j, rank, None]]
+            found_all = False
+            while stack:
+                frame = stack[-1]
+                t, j, rank, waiting = frame
+                found = paths[t][j]
+                emis = self.emis_array[j, symbols[t]]
+                if waiting is not None:
+                    # The path found last is replaced by the next path to
+                    # its preceding state, if there is one.
+                    heap = heaps[t][j]
+                    i, r = waiting
+                    if found_all:
+                        score = combine(combine(paths[t-1][i][r][0], self.tran_array[i, j]), emis)
+                        heapq.heappush(heap, (-score, i, r))
+                    frame[3] = None
+                    if len(heap) == 0:
+                        found_all = False
+                        stack.pop()
+                        continue
+                    score, i, r = heapq.heappop(heap)
+                    found.append((-score, i, r))
+                if t == 0 or len(found) > rank:
+                    found_all = len(found) > rank
+                    stack.pop()
+                    continue
+                if heaps[t][j] is None:
+                    scores = combine(combine(delta[t-1], self.tran_array[:, j]), emis)
+                    heap = [(-score, i, 0) for i, score in enumerate(scores.tolist())
+                            if i != found[0][1]]
+                    heapq.heapify(heap)
+                    heaps[t][j] = heap
+                _, i, r = found[-1]
+                frame[3] = (i, r + 1)
+                stack.append([t - 1, i, r + 1, None])
+            return found_all
+
+        # The final paths are chosen the same way among the paths to every
+        # state at the last time step.
+        last = len(word) - 1
+        heap = [(-score, j, 0) for j, score in enumerate(delta[last].tolist())]
+        heapq.heapify(heap)
+        k_best = []
+        while len(k_best) < k and len(heap) > 0:
+            score, j, rank = heapq.heappop(heap)
+            seq = []
+            state, r = j, rank
+            for t in xrange(last, -1, -1):
+                seq.append(self.states[state])
+                _, state, r = paths[t][state][r]
+            k_best.append((''.join(reversed(seq)), float(-score)))
+            if find_path(last, j, rank + 1):
+                heapq.heappush(heap, (-paths[last][j][rank+1][0], j, rank + 1))
+        self.stats['exact_steps'] += len(word)
+
+        return k_best
+
+
+    # A beam is a tuple (probs, states, parents). probs holds the scores of
+    # the current paths. Only the last state and the index of the preceding
+    # path are stored at each time step, and the sequences are rebuilt from
+    # these at the end.
+
+    def _beam_start(self, symbol):
+        # Single symbol input is just initial * emission. All N paths are
+        # kept, as the first two characters are decoded together.
+        n = len(self.states)
+        return (self.combine(self.init_array, self.emis_array[:, symbol]), [np.arange(n)], [None])
+
+
+    def _beam_step(self, beam, symbol, k):
+        if self.prune_ratio is not None or self.beam_budget is not None:
+            beam = self._beam_prune(beam)
+        if self.emitting_states is not None:
+            allowed = self.emitting_states[symbol]
+            step = self._beam_expand(beam, symbol, k, allowed)
+            # Every candidate left out scores at most the floor, so the step
+            # is exact (for a floor of 0) unless it is short of k paths that
+            # are possible. Otherwise all states are expanded after all.
+            impossible = -np.inf if self.log_space else 0.0
+            if len(step[0]) >= min(k, len(beam[0]) * len(self.states)) and step[0][-1] > impossible:
+                self.stats['sparse_steps'] += 1
+                return step
+            self.stats['dense_steps'] += 1
+        return self._beam_expand(beam, symbol, k)
+
+
+    def _beam_prune(self, beam):
+        # The beam with only the paths worth extending at its last step.
+        # Parents still index the previous step, and the new step will
+        # index the paths kept here.
+        probs, states, parents = beam
+        best = np.argmax(probs)
+        if self.beam_budget is not None and sum(len(x) for x in states[1:]) >= self.beam_budget:
+            keep = np.array([best])
+            self.stats['budget_steps'] += 1
+        elif self.prune_ratio is not None:
+            if self.log_space:
+                threshold = probs[best] + math.log(self.prune_ratio)
+            else:
+                threshold = probs[best] * self.prune_ratio
+            keep = np.flatnonzero(probs >= threshold)
+        else:
+            return beam
+        self.stats['pruned_paths'] += len(probs) - len(keep)
+        if parents[-1] is None:
+            last_parents = None
         else:
-            # Create the N*N sequences for the first two characters
-            # of the word.
-            paths = [((i, j), (self.init[i] * self.emis[i][word[0]] * self.tran[i][j] * self.emis[j][word[1]]))
-                     for i in self.states for j in self.states]
+            last_parents = parents[-1][keep]
+        return (probs[keep], states[:-1] + [states[-1][keep]], parents[:-1] + [last_parents])
 
-            # Keep the k best sequences.
-            paths = sorted(paths, key=lambda x: x[1], reverse=True)[:k]
 
+    def _beam_expand(self, beam, symbol, k, allowed=None):
+        # Extend the paths of the beam with the allowed states (all of them
+        # by default), keeping the k best.
+        combine = self.combine
+        probs, states, parents = beam
+        width = len(probs)
+        tran = self.tran_array[states[-1]]
+        emis = self.emis_array[:, symbol]
+        if allowed is None:
+            n = len(self.states)
+        else:
+            n = len(allowed)
+            tran = tran[:, allowed]
+            emis = emis[allowed]
+
+        if len(states) == 1:
+            # Create the N*N sequences for the first two characters of the
+            # word, flattened so that index i*N + j is the sequence (i, j).
+            temp = combine(combine(probs[:, np.newaxis], tran), emis).ravel()
+            best = self._top_k(temp, k)
+            new_states, new_parents = best % n, best // n
+        else:
             # Continue through the input word, only keeping k sequences at
-            # each time step.
-            for t in xrange(2, len(word)):
-                temp = [(x[0] + (j,), (x[1] * self.tran[x[0][-1]][j] * self.emis[j][word[t]]))
-                         for j in self.states for x in paths]
-                paths = sorted(temp, key=lambda x: x[1], reverse=True)[:k]
+            # each time step. Candidate (j, p) extends path p with state j
+            # and is found at index j*width + p, matching the old candidate
+            # ordering.
+            temp = combine(combine(probs, tran.T), emis[:, np.newaxis]).ravel()
+            best = self._top_k(temp, k)
+            new_states, new_parents = best // width, best % width
 
-        
-        return [(''.join(seq), prob) for seq, prob in paths[:k]]
+        if allowed is not None:
+            new_states = allowed[new_states]
+        return (temp[best], states + [new_states], parents + [new_parents])
+
+
+    def _beam_merge(self, a, b, k):
+        # Join two beams of paths of the same length, keeping the k best
+        # (or all of them after the first symbol, as in _beam_start).
+        # The step arrays are concatenated, with the parent indices of b
+        # shifted past those of a.
+        probs = np.concatenate([a[0], b[0]])
+        states = [np.concatenate([x, y]) for x, y in zip(a[1], b[1])]
+        parents = [None] + [np.concatenate([x, y + len(prev)])
+                            for x, y, prev in zip(a[2][1:], b[2][1:], a[1])]
+        if len(states) == 1:
+            return (probs, states, parents)
+        best = self._top_k(probs, k)
+        return (probs[best], [x[best] if t == len(states) - 1 else x for t, x in enumerate(states)],
+                parents[:-1] + [parents[-1][best]])
+
+
+    def k_best_lattice(self, word, k, substitutions, width=None):
+        # k-best decodings over all readings of the word at once.
+        # substitutions is a list of (start, end, replacement), each an
+        # alternative reading of word[start:end]. Beams of width paths
+        # (k by default) are kept for each (position in the word, number of
+        # symbols read) and extended along every edge from that position;
+        # beams that meet are merged.
+        if width is None:
+            width = k
+        edges = collections.defaultdict(list)
+        for start, end, replacement in substitutions:
+            edges[start].append((end, replacement))
+
+        beams = {(0, 0):None}
+        for position in xrange(len(word)):
+            for key in sorted(key for key in beams if key[0] == position):
+                beam = beams.pop(key)
+                for end, symbols in [(position + 1, word[position])] + edges[position]:
+                    extended = beam
+                    for c in symbols:
+                        symbol = self.symbol_ids[c]
+                        if extended is None:
+                            extended = self._beam_start(symbol)
+                        else:
+                            extended = self._beam_step(extended, symbol, width)
+                    self.stats['beam_steps'] += len(symbols)
+
+                    if extended is None:
+                        continue
+                    target = (end, key[1] + len(symbols))
+                    if target in beams and beams[target] is not None:
+                        beams[target] = self._beam_merge(beams[target], extended, width)
+                    else:
+                        beams[target] = extended
 
+        k_best = [path for beam in beams.itervalues() if beam is not None
+                  for path in self._beam_result(beam, k)]
+        return sorted(k_best, key=lambda x: x[1], reverse=True)[:k]
 
 
-class UnicodeWriter:
+    def _beam_result(self, beam, k):
+        probs, states, parents = beam
+        best = self._top_k(probs, k)
+        return zip(self._sequences(states, parents, best),
+                   [float(prob) for prob in probs[best]])
+
+
+    def k_best_lexicon(self, word, k, lexicon, width=20):
+        # Beam search restricted to paths that spell a word of the
+        # LexiconTrie, keeping width paths at each time step and returning
+        # the k best complete words. States for punctuation characters do
+        # not advance in the trie. Paths with zero probability, or that can
+        # no longer reach the end of a word in the remaining characters,
+        # are dropped. The beam can miss the best words; with width None,
+        # the k best paths to each trie node and state are kept instead,
+        # which finds the k best words exactly but can be much slower.
+        emis = self.emis_array[:, [self.symbol_ids[c] for c in word]]
+        combine = self.combine
+
+        impossible = float('-inf') if self.log_space else 0.0
+        free_states = [i for i, s in enumerate(self.states) if s in lexicon.punctuation]
+        expansions = dict()
+        def expand(node):
+            # (state ids, trie nodes) reachable from a trie node
+            if node not in expansions:
+                children = [(self.state_ids[c], child)
+                            for c, child in lexicon.children[node].iteritems()
+                            if c in self.state_ids]
+                expansions[node] = (np.array([i for i, _ in children] + free_states, dtype=int),
+                                    np.array([child for _, child in children] +
+                                             [node] * len(free_states), dtype=int))
+            return expansions[node]
+
+        ids, nodes = expand(0)
+        scores = combine(self.init_array[ids], emis[ids, 0])
+        parent_ids = np.zeros(len(ids), dtype=int)
+        states, parents = [], []
+        for t in xrange(len(word)):
+            if t > 0:
+                candidates = [expand(node) for node in nodes]
+                ids = np.concatenate([c[0] for c in candidates])
+                parent_ids = np.repeat(np.arange(len(nodes)), [len(c[0]) for c in candidates])
+                nodes = np.concatenate([c[1] for c in candidates])
+                scores = combine(combine(scores[parent_ids], self.tran_array[states[-1][parent_ids], ids]),
+                                 emis[ids, t])
+
+            feasible = ((lexicon.min_remaining[nodes] <= len(word) - t - 1) &
+                        (scores > impossible))
+            if width is None:
+                best = np.flatnonzero(feasible)[self._top_k_per_key(
+                    scores[feasible], nodes[feasible] * len(self.states) + ids[feasible], k)]
+            else:
+                best = np.flatnonzero(feasible)[self._top_k(scores[feasible], width)]
+            scores, nodes = scores[best], nodes[best]
+            states.append(ids[best])
+            parents.append(parent_ids[best] if t > 0 else None)
+            if len(best) == 0:
+                return []
+
+        # Only paths ending on a word are left after the last step.
+        return zip(self._sequences(states, parents), [float(score) for score in scores])[:k]
+
+
+    def _sequences(self, states, parents, index=None):
+        # Rebuild the state sequences of the final paths (or those given by
+        # index) from the state and the index of the preceding path stored
+        # at each time step.
+        if index is None:
+            index = np.arange(len(states[-1]))
+        seqs = [[] for _ in index]
+        for t in xrange(len(states) - 1, -1, -1):
+            for seq, state in zip(seqs, states[t][index]):
+                seq.append(self.states[state])
+            if parents[t] is not None:
+                index = parents[t][index]
+        return [''.join(reversed(seq)) for seq in seqs]
+
+
+    @staticmethod
+    def _top_k_per_key(scores, keys, k):
+        # Indices of the k highest scores for each key, best first overall.
+        # Ties keep their original order.
+        order = np.lexsort((np.arange(len(scores)), -scores, keys))
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        kept = np.sort(order[rank < k])
+        return kept[np.argsort(-scores[kept], kind='mergesort')]
+
+
+    @staticmethod
+    def _top_k(scores, k):
+        # Indices of the k highest scores, best first. Ties keep their
+        # original order, as with the stable sorted() used previously, so
+        # everything tied with the k-th best score stays in the running.
+        candidates = np.arange(len(scores))
+        if 0 < k < len(scores):
+            kth = scores[np.argpartition(scores, len(scores) - k)[len(scores) - k]]
+            candidates = candidates[scores >= kth]
+        order = np.argsort(-scores[candidates], kind='mergesort')
+        return candidates[order[:k]]
+
+
+
+class LexiconTrie(object):
     """
-    A CSV writer which will write rows to CSV file "f",
-    which is encoded in the given encoding.
-    Source: https://docs.python.org/2/library/csv.html
+    Character trie of dictionary words, used to restrict decoding to words
+    that pass the dictionary check. As in the asymmetric check of tune.py
+    and correct.py, a word starting with a capital letter also passes if
+    its lower case form is in the dictionary, so after a capital, the
+    characters of lower case entries may be in either case ('Cat', 'CAT'
+    and 'CaT' for 'cat'). Punctuation is stripped before the dictionary
+    check, so dictionary entries containing punctuation can never match
+    and are left out.
     """
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        # Redirect output to a queue
-        self.queue = cStringIO.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
+    # Everything from string.punctuation
+    punctuation = '!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'
+
+    def __init__(self, words):
+        self.words = set(word for word in words
+                         if len(word) > 0 and not any(c in self.punctuation for c in word))
+        # Tries of the entries as they are, and of the lower case entries,
+        # as lists of {character: child} and of whether a node ends a word
+        exact = self._build(self.words)
+        folded = self._build(word for word in self.words if word == word.lower())
+
+        # The trie actually walked follows both at once: each of its nodes
+        # is a pair of nodes (or None) of the exact and the folded tries.
+        # Node 0 is the root. children[node] maps a character to a node.
+        self.children = [dict()]
+        self.terminal = [False]
+        pairs = [(0, None)]
+        node_ids = {(0, None): 0}
+        node = 0
+        while node < len(pairs):
+            exact_node, folded_node = pairs[node]
+            moves = dict()
+            if exact_node is not None:
+                for c, child in exact[0][exact_node].iteritems():
+                    moves[c] = [child, None]
+            # A lower case entry is entered with a capital letter, and
+            # continued in either case
+            if node == 0:
+                folded_children = folded[0][0]
+                cases = lambda c: [c.upper()]
+            elif folded_node is not None:
+                folded_children = folded[0][folded_node]
+                cases = lambda c: [c, c.upper()]
+            else:
+                folded_children = {}
+            for c, child in folded_children.iteritems():
+                for x in cases(c):
+                    if len(x) == 1 and x.lower() == c and (node > 0 or x != c):
+                        moves.setdefault(x, [None, None])[1] = child
+            for x, pair in moves.iteritems():
+                pair = tuple(pair)
+                if pair not in node_ids:
+                    node_ids[pair] = len(pairs)
+                    pairs.append(pair)
+                    self.children.append(dict())
+                    self.terminal.append((pair[0] is not None and exact[1][pair[0]]) or
+                                         (pair[1] is not None and folded[1][pair[1]]))
+                self.children[node][x] = node_ids[pair]
+            node += 1
+
+        # Fewest characters still needed to complete a word from each
+        # node. Children always come after their parent. The root of an
+        # empty trie cannot complete a word at all.
+        unreachable = len(self.children) + 1
+        min_remaining = [0] * len(self.children)
+        for node in xrange(len(self.children) - 1, -1, -1):
+            if not self.terminal[node]:
+                min_remaining[node] = 1 + min([min_remaining[child] for child in
+                                               self.children[node].itervalues()] or [unreachable])
+        self.min_remaining = np.array(min_remaining)
+
+    @staticmethod
+    def _build(words):
+        children = [dict()]
+        terminal = [False]
+        for word in words:
+            node = 0
+            for c in word:
+                if c not in children[node]:
+                    children[node][c] = len(children)
+                    children.append(dict())
+                    terminal.append(False)
+                node = children[node][c]
+            terminal[node] = True
+        return children, terminal
+
+    def __contains__(self, word):
+        node = 0
+        for c in word:
+            if c not in self.children[node]:
+                return False
+            node = self.children[node][c]
+        return self.terminal[node]
+
+    def fingerprint(self):
+        return hashlib.sha1(json.dumps(sorted(self.words))).hexdigest()
+
+
+
+class TSVWriter(object):
+    """
+    Writes rows to the file "f" as tab-separated lines in the given
+    encoding, as csv.writer does with csv.excel_tab and QUOTE_NONE: lines
+    end with \r\n and floats are written with repr, or with precision
+    significant digits if given. Fields must not contain tabs or line
+    breaks. Lines are collected and written buffer_size characters at a
+    time, so flush() must be called when done.
+    """
+
+    def __init__(self, f, precision=None, encoding='utf-8', buffer_size=1 << 16):
         self.stream = f
-        self.encoder = codecs.getincrementalencoder(encoding)()
+        self.encoding = encoding
+        if precision is None:
+            self.format_float = float.__repr__
+        else:
+            self.format_float = '{{:.{}g}}'.format(precision).format
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
 
     def writerow(self, row):
-        #self.writer.writerow([s.encode("utf-8") for s in row])
-        
-        # Modification to avoid attempting to encode non-unicode entries.
-        self.writer.writerow([s.encode("utf-8") if type(s) == unicode else s for s in row])
-        
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
+        # Unicode strings and floats are checked for first, as most fields are one or the other
+        format_float = self.format_float
+        line = u'\t'.join([x if type(x) is unicode else
+                            format_float(x) if type(x) is float else
+                            self._field(x) for x in row]) + u'\r\n'
+        self.buffer.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_size:
+            self.flush()
 
     def writerows(self, rows):
         for row in rows:
             self.writerow(row)
 
+    def _field(self, x):
+        if isinstance(x, unicode):
+            return x
+        elif isinstance(x, float):
+            return self.format_float(x)
+        elif isinstance(x, str):
+            return x.decode(self.encoding)
+        elif x is None:
+            return u''
+        return unicode(x)
+
+    def flush(self):
+        self.stream.write(u''.join(self.buffer).encode(self.encoding))
+        self.buffer = []
+        self.buffered = 0
+
+
+
+class DecodingCache(stores.SQLiteStore):
+    """
+    Decodings stored in a SQLite database, to be used in place of the
+    prev_decodings dict of a Decoder. Entries are looked up one token at a
+    time and are keyed by the decoder fingerprint, so decodings made with
+    another model or other settings are never returned.
+    The database can be shared by several runs and processes at once.
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS decodings '
+              '(model TEXT, token TEXT, decoding TEXT, '
+              'PRIMARY KEY (model, token))')
+
+    def __init__(self, filename, fingerprint):
+        stores.SQLiteStore.__init__(self, filename)
+        self.fingerprint = fingerprint
+
+    def get(self, word, default=None):
+        row = self._db().execute('SELECT decoding FROM decodings '
+                                 'WHERE model = ? AND token = ?',
+                                 (self.fingerprint, word)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __getitem__(self, word):
+        decoding = self.get(word)
+        if decoding is None:
+            raise KeyError(word)
+        return decoding
+
+    def __setitem__(self, word, decoding):
+        self._db().execute('INSERT OR REPLACE INTO decodings VALUES (?, ?, ?)',
+                           (self.fingerprint, word, json.dumps(decoding)))
 
+    def __len__(self):
+        return self._db().execute('SELECT COUNT(*) FROM decodings WHERE model = ?',
+                                  (self.fingerprint,)).fetchone()[0]
 
-def load_hmm(filename):
+    def purge(self):
+        # Remove decodings made with other models or settings.
+        self._db().execute('DELETE FROM decodings WHERE model != ?',
+                           (self.fingerprint,))
+
+
+
+class DecodingMemo(object):
+    """
+    A size-limited replacement for the prev_decodings dict of a Decoder.
+    Once max_entries or max_bytes is exceeded, entries are evicted either
+    least recently used first ('lru') or least frequently used first,
+    oldest first among equals ('lfu'). Decodings are stored as tuples.
+    hits, misses and evictions count the lookups and evictions so far.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, policy='lru'):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError('Unknown eviction policy: {}'.format(policy))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+        # word -> (decoding, use count, size in bytes)
+        self.entries = dict()
+        # use count -> words with that count, oldest first. The LRU
+        # policy keeps every word under count 0.
+        self.buckets = collections.defaultdict(collections.OrderedDict)
+        self.min_count = 0
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, word, default=None):
+        entry = self.entries.get(word)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+
+        decoding, count, size = entry
+        del self.buckets[count][word]
+        if self.policy == 'lfu':
+            if not self.buckets[count]:
+                del self.buckets[count]
+                if self.min_count == count:
+                    self.min_count = count + 1
+            count += 1
+            self.entries[word] = (decoding, count, size)
+        self.buckets[count][word] = None
+        return decoding
+
+    def __contains__(self, word):
+        return word in self.entries
+
+    def __getitem__(self, word):
+        decoding = self.get(word)
+        if decoding is None:
+            raise KeyError(word)
+        return decoding
+
+    def __setitem__(self, word, decoding):
+        if word in self.entries:
+            self._remove(word)
+        decoding = tuple(decoding)
+        size = (sys.getsizeof(word) + sys.getsizeof(decoding) +
+                sum(sys.getsizeof(x) for x in decoding))
+
+        # Make room for the new entry before adding it.
+        while self.entries and ((self.max_entries is not None and len(self.entries) >= self.max_entries) or
+                                (self.max_bytes is not None and self.size + size > self.max_bytes)):
+            while not self.buckets.get(self.min_count):
+                self.min_count += 1
+            self._remove(next(iter(self.buckets[self.min_count])))
+            self.evictions += 1
+
+        count = 1 if self.policy == 'lfu' else 0
+        self.entries[word] = (decoding, count, size)
+        self.buckets[count][word] = None
+        self.min_count = count
+        self.size += size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _remove(self, word):
+        _, count, size = self.entries.pop(word)
+        del self.buckets[count][word]
+        if not self.buckets[count]:
+            del self.buckets[count]
+        self.size -= size
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+
+# Binary model files start with this tag, followed by the length of a JSON
+# header holding the states and symbols, the header itself (padded to a
+# multiple of 8 bytes), and then the initial, transition and emission
+# tables as little-endian float64 arrays in state/symbol order.
+HMM_MAGIC = 'HMMBIN01'
+
+
+def load_hmm(filename, log_space=False):
     with open(filename, 'rb') as f:
-        h = HMM(*json.load(f, 'utf-8'))
+        if f.read(len(HMM_MAGIC)) == HMM_MAGIC:
+            return load_hmm_binary(filename, log_space)
+        f.seek(0)
+        h = HMM(*json.load(f, 'utf-8'), log_space=log_space)
     return h
 
 
+# The tables are memory-mapped read-only, so loading is nearly instant and
+# processes using the same file share its pages. (In log space the tables
+# are converted into ordinary arrays.)
+def load_hmm_binary(filename, log_space=False):
+    with open(filename, 'rb') as f:
+        if f.read(len(HMM_MAGIC)) != HMM_MAGIC:
+            raise ValueError('{} is not a binary HMM file'.format(filename))
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_length))
+
+    n = len(header['states'])
+    m = len(header['symbols'])
+    tables = np.memmap(filename, dtype='<f8', mode='r',
+                       offset=len(HMM_MAGIC) + 8 + header_length,
+                       shape=(n + n*n + n*m,))
+    return HMM.from_arrays(header['states'], header['symbols'],
+                           tables[:n],
+                           tables[n:n + n*n].reshape(n, n),
+                           tables[n + n*n:].reshape(n, m),
+                           log_space)
+
+
+def write_hmm_binary(filename, hmm):
+    if hmm.log_space:
+        raise ValueError('Only HMMs with linear probabilities can be written.')
+
+    header = json.dumps({'states':hmm.states, 'symbols':hmm.symbols})
+    header += ' ' * (-(len(HMM_MAGIC) + 8 + len(header)) % 8)
+    with open(filename, 'wb') as f:
+        f.write(HMM_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for table in (hmm.init_array, hmm.tran_array, hmm.emis_array):
+            f.write(np.ascontiguousarray(table, dtype='<f8').tostring())
+
+
+def convert_hmm(json_file, binary_file):
+    write_hmm_binary(binary_file, load_hmm(json_file))
+
+
+
+# Columnar decodings: the rows of a decodings CSV file - the leading word
+# columns (the original token, or the gold and original forms) followed by
+# k (candidate, probability) pairs - stored as arrays that are
+# memory-mapped when read. Each string is stored once, in a table in the
+# header along with the id of its form without punctuation. After the
+# header come the probabilities as float64 (float32 would underflow to 0.0
+# for long words) and the string ids as int32.
+DECODINGS_MAGIC = 'DECBIN01'
+
+
+# The word without Unicode punctuation, as regex.sub(ur"\p{P}+", "", word)
+# in tune.py and correct.py.
+def strip_unicode_punctuation(word):
+    return u''.join([c for c in word if not unicodedata.category(c).startswith('P')])
+
+
+class ColumnarWriter(object):
+    """
+    Writes rows of decodings to the file "filename" in the columnar format.
+    Missing fields are stored as empty strings, and probabilities that are
+    not numbers (as in a header line) as nan. Probabilities are rounded to
+    precision significant digits if given, as TSVWriter writes them. The
+    arrays are kept in memory until close() is called.
+    """
+
+    def __init__(self, filename, k, words=1, precision=None):
+        self.filename = filename
+        self.k = k
+        self.words = words
+        if precision is None:
+            self.round = float
+        else:
+            self.round = lambda x: float('{{:.{}g}}'.format(precision).format(float(x)))
+        self.strings = []
+        self.string_ids = dict()
+        self.ids = array.array('i')
+        self.probs = array.array('d')
+        self.rows = 0
+
+    def intern(self, string):
+        if isinstance(string, str):
+            string = string.decode('utf-8')
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    def writerow(self, row):
+        for i in xrange(self.words):
+            self.ids.append(self.intern(row[i] if i < len(row) else u''))
+        for i in xrange(self.words, self.words + 2 * self.k, 2):
+            self.ids.append(self.intern(row[i] if i < len(row) else u''))
+            try:
+                self.probs.append(self.round(row[i+1]))
+            except (IndexError, ValueError):
+                self.probs.append(float('nan'))
+        self.rows += 1
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        # Stripped forms are interned too, so the table grows in the loop
+        stripped = array.array('i')
+        i = 0
+        while i < len(self.strings):
+            stripped.append(self.intern(strip_unicode_punctuation(self.strings[i])))
+            i += 1
+
+        header = json.dumps({'rows':self.rows, 'k':self.k, 'words':self.words,
+                             'strings':self.strings})
+        header += ' ' * (-(len(DECODINGS_MAGIC) + 8 + len(header)) % 8)
+        with open(self.filename, 'wb') as f:
+            f.write(DECODINGS_MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for values, dtype in ((self.probs, '<f8'), (self.ids, '<i4'), (stripped, '<i4')):
+                f.write(np.asarray(values, dtype=dtype).tostring())
+
+
+class Decodings(object):
+    """
+    Decodings read from a columnar file. ids[i] holds the string ids of the
+    words and candidates of row i, and probs[i] its probabilities. The
+    string with id x is strings[x], and strings[stripped[x]] is its form
+    without punctuation.
+    """
+
+    def __init__(self, strings, stripped, ids, probs, words, k):
+        self.strings = strings
+        self.stripped = stripped
+        self.ids = ids
+        self.probs = probs
+        self.words = words
+        self.k = k
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self):
+        # The rows as lists of fields, as if split from the CSV lines, but
+        # with the probabilities as floats.
+        strings = self.strings
+        words = self.words
+        for ids, probs in itertools.izip(self.ids.tolist(), self.probs.tolist()):
+            row = [strings[x] for x in ids[:words]]
+            for x, prob in zip(ids[words:], probs):
+                row.append(strings[x])
+                row.append(prob)
+            yield row
+
+    def stripped_forms(self):
+        # A dict from each string to its form without punctuation
+        strings = self.strings
+        return {string:strings[x] for string, x in zip(strings, self.stripped.tolist())}
+
+
+def load_decodings_binary(filename):
+    with open(filename, 'rb') as f:
+        if f.read(len(DECODINGS_MAGIC)) != DECODINGS_MAGIC:
+            raise ValueError('{} is not a columnar decodings file'.format(filename))
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_length))
+
+    rows, k, words = header['rows'], header['k'], header['words']
+    offset = len(DECODINGS_MAGIC) + 8 + header_length
+    # np.memmap cannot map an empty file region. Without rows there are
+    # no strings either.
+    if rows == 0:
+        probs = np.zeros((0, k))
+        ids = np.zeros((0, words + k), dtype='<i4')
+        stripped = np.zeros((0,), dtype='<i4')
+    else:
+        probs = np.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=(rows, k))
+        offset += probs.nbytes
+        ids = np.memmap(filename, dtype='<i4', mode='r', offset=offset, shape=(rows, words + k))
+        offset += ids.nbytes
+        stripped = np.memmap(filename, dtype='<i4', mode='r', offset=offset,
+                             shape=(len(header['strings']),))
+    return Decodings(header['strings'], stripped, ids, probs, words, k)
+
+
+def convert_decodings(csv_file, binary_file, k, words=1):
+    writer = ColumnarWriter(binary_file, k, words)
+    writer.writerows(load_csv_unicode(csv_file))
+    writer.close()
+
+
 def load_dictionary(filename):
     with open(filename, 'rb') as f:
         worddict = set([i.decode('utf-8').strip() for i in f])
     return worddict
 
 
-def load_text(filename, header=0):
+# Tokens of a text: runs of characters other than whitespace, and each
+# newline and carriage return, which are kept to recreate the text later.
+token_pattern = re.compile(r'[\r\n]|[^\s]+', re.UNICODE)
+
+
+def iter_text(filename, header=0):
+    # The tokens of the file after the header lines, read one line at a
+    # time so that large files are never held in memory.
     with open(filename, 'rb') as f:
-        data = [i.decode('utf-8') for i in f][header:]
-    words = []
-    temp = []
-    for line in data:
-        for char in line:
-            # Keep newline and carriage return, but discard other whitespace
-            if char.isspace():
-                if char == '\n' or char == '\r':
-                    if len(temp) > 0:
-                        words.append(''.join(temp))
-                    words.append(char)
-                    temp = []
-                else:
-                    if len(temp) > 0:
-                        words.append(''.join(temp))
-                    temp = []
-            else:
-                temp.append(char)
-                
-    # Add the last word
-    if len(temp) > 0:
-        words.append(''.join(temp))
-                
-    return words
+        for line in itertools.islice(f, header, None):
+            for token in token_pattern.findall(line.decode('utf-8')):
+                yield token
+
+
+def load_text(filename, header=0):
+    return list(iter_text(filename, header))
 
 
 def load_csv_unicode(filename, delimiter='\t', quoting=csv.QUOTE_NONE):
+    if quoting != csv.QUOTE_NONE:
+        with open(filename, 'rb') as f:
+            reader = csv.reader(f, delimiter=delimiter, quoting=quoting)
+            data = [[unicode(element, 'utf-8') for element in line]
+                    for line in reader]
+        return data
+
+    # Without quoting, each line is simply split at the delimiter
     with open(filename, 'rb') as f:
-        reader = csv.reader(f, delimiter=delimiter, quoting=quoting)
-        data = [[unicode(element, 'utf-8') for element in line]
-                for line in reader]
+        lines = f.read().decode('utf-8').split(u'\n')
+    if lines[-1] == u'':
+        lines.pop()
+    data = []
+    for line in lines:
+        if line.endswith(u'\r'):
+            line = line[:-1]
+        data.append(line.split(delimiter) if line else [])
     return data
@@ -1,6 +1,8 @@
 import argparse
-import csv
+import collections
+import itertools
 import json
+import multiprocessing
 import os
 
 import decoder
@@ -12,20 +14,186 @@ import decoder
 num_header_lines = 12
 kn = 4
 use_existing_decodings = True
+# Score paths with summed log probabilities (avoids underflow on long words)
+use_log_probabilities = False
+# Write linear probabilities to the CSV even when scoring in log space.
+# tune.py and correct.py expect linear probabilities.
+output_linear_probabilities = True
+# Decode each distinct token of the whole input once, most frequent first,
+# before writing the per-file decodings (also enabled with --vocabulary)
+decode_by_vocabulary = False
+# Number of decoded types between progress reports in vocabulary mode
+progress_interval = 1000
+# Worker processes for vocabulary decoding (also set with --processes).
+# More than one implies vocabulary mode.
+num_processes = 1
+# Number of types handed to a worker at a time
+chunk_size = 200
+# In vocabulary mode, decode the types in alphabetical chunks and reuse the
+# beam of prefixes shared by several types (results are unchanged)
+share_prefixes = False
+# Limits on the decodings kept in memory (None for no limit), and which
+# ones to evict first when a limit is reached: 'lru' or 'lfu'
+memo_max_entries = None
+memo_max_bytes = None
+memo_policy = 'lru'
+# If none of the k-best decodings is in the dictionary, replace the last one
+# with the best decoding found by a beam search over the dictionary words
+# (lexicon_width paths wide, which can miss the best word; None for an
+# exact but slower search)
+use_lexicon_decoding = False
+lexicon_width = 20
+# How substitutions from multichar_file are tried: 'variants' decodes every
+# combination separately, 'lattice' decodes them all in one beam pass.
+# A wider lattice beam keeps more of the variants' paths (None for kn).
+multichar_engine = 'variants'
+lattice_width = None
+# Only extend beam paths with states whose emission probability for the
+# next character is above this floor (None to expand every state).
+# 0 leaves the decodings unchanged; higher floors are faster but approximate.
+emission_floor = None
+# How the k-best decodings are found: 'beam' (fast) or 'exact' (the true k
+# most probable decodings; pruning and emission_floor do not apply)
+decoding_engine = 'beam'
+# Decode words that pass the dictionary check as themselves, without a
+# search, if each of their characters is emitted by its own state with at
+# least this probability (e.g. 0.9; None to always search)
+fast_path_min_emission = None
+# Stop extending beam paths that score below prune_ratio times the best one
+# (e.g. 1e-4), and extend only the best path of a token once beam_budget
+# paths have been extended for it (None for no limit). Both are approximate;
+# audit_pruning decodes every token again without them and reports how
+# often the k-best list changed.
+prune_ratio = None
+beam_budget = None
+audit_pruning = False
 
 # Inputs
+# JSON parameters, or the binary copy written by model_builder.py
+# ('resources/hmm_parameters.bin') which loads much faster
 hmm_params = 'resources/hmm_parameters.txt'
 dict_file = 'resources/dictionary.txt'
 multichar_file = 'resources/multichar_errors.txt'
 
 # Output
 dir_decodings = 'decoded/'
+# Significant digits written for probabilities (None for all of them)
+float_precision = None
+# Also write each file's decodings in the columnar format (_decoded.bin),
+# which tune.py and correct.py read with -b y
+write_columnar = False
+# SQLite database of decodings shared across runs (also set with --cache).
+# When set, it is used instead of re-reading the CSVs in dir_decodings, and
+# decodings made with a different model or settings are not reused.
+decoding_cache = ''
+# Remove the decodings made with other models, dictionaries or settings
+# from the cache before decoding (also set with --purge-cache)
+purge_decoding_cache = False
 
 #-------------------------------------
 
+# A single text file, or every file in a directory.
+def input_files(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, filename) for filename in sorted(os.listdir(path))]
+    return [path]
+
+
+# Rows are written as they are produced, so decoded_words may be a generator.
+def write_decodings(input_file, decoded_words):
+    output_file = os.path.join(dir_decodings, os.path.splitext(os.path.basename(input_file))[0] + '_decoded')
+
+    with open(output_file + '.csv', 'wb') as f:
+        writer = decoder.TSVWriter(f, float_precision)
+        if write_columnar:
+            columnar = decoder.ColumnarWriter(output_file + '.bin', kn, precision=float_precision)
+        for row in decoded_words:
+            writer.writerow(row)
+            if write_columnar:
+                columnar.writerow(row)
+        writer.flush()
+    if write_columnar:
+        columnar.close()
+
+
+# Count the tokens of all the input files, leaving out newlines.
+def vocabulary(filenames):
+    counts = collections.Counter()
+    for filename in filenames:
+        counts.update(word for word in decoder.iter_text(filename, num_header_lines)
+                      if word != '\n' and word != '\r')
+    return counts
+
+
+# The decoder and multichars used by worker processes. They are set before
+# the pool is created, so forked workers share the HMM tables with the
+# parent process instead of receiving pickled copies.
+_worker_state = dict()
+
+
+def _decode_chunk(words):
+    dec = _worker_state['decoder']
+    multichars = _worker_state['multichars']
+    stats = collections.Counter(dec.hmm.stats)
+    if share_prefixes:
+        decodings = dec.decode_words(words, kn, multichars)
+        decodings = [(word, decodings[word]) for word in words]
+    else:
+        decodings = [(word, dec.decode_word(word, kn, multichars)) for word in words]
+    # Decoding work done for this chunk, to be added up by the parent
+    stats = collections.Counter({key:dec.hmm.stats[key] - stats[key] for key in dec.hmm.stats})
+    return decodings, stats
+
+
+# Decode each distinct token once, most frequent first, so that the
+# progress reports show how much of the running text is done. With more
+# than one process, chunks of types are spread over a pool of workers.
+def decode_vocabulary(dec, counts, multichars, processes=1):
+    _worker_state['decoder'] = dec
+    _worker_state['multichars'] = multichars
+
+    words = [word for word, _ in counts.most_common()]
+    if share_prefixes:
+        words.sort()
+    chunks = [words[i:i + chunk_size] for i in xrange(0, len(words), chunk_size)]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_decode_chunk, chunks)
+    else:
+        pool = None
+        results = itertools.imap(_decode_chunk, chunks)
+
+    total = sum(counts.itervalues())
+    done = 0
+    decodings = dict()
+    for chunk, stats in results:
+        # Work done in worker processes is not counted in this one
+        if pool is not None:
+            dec.hmm.stats.update(stats)
+        for word, decoding in chunk:
+            decodings[word] = decoding
+            done += counts[word]
+            if len(decodings) % progress_interval == 0 or len(decodings) == len(counts):
+                print 'Decoded {} of {} types ({:.1f}% of tokens)'.format(
+                    len(decodings), len(counts), 100.0 * done / total)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return decodings
+
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('input_file', help='text file to decode')
+    parser.add_argument('input_file', help='text file or directory of text files to decode')
+    parser.add_argument('--vocabulary', action='store_true',
+                        help='decode each distinct token of the input once before writing')
+    parser.add_argument('--processes', type=int, default=num_processes,
+                        help='number of worker processes for vocabulary decoding')
+    parser.add_argument('--cache', default=decoding_cache,
+                        help='SQLite file of decodings to reuse and extend')
+    parser.add_argument('--purge-cache', action='store_true',
+                        help='remove decodings made with other models or settings from the cache')
 
     args = parser.parse_args()
 
@@ -33,41 +201,96 @@ if __name__=='__main__':
     for i in xrange(kn):
         decoded_header.extend(['{}-best'.format(i+1), '{}-best prob.'.format(i+1)])
 
+    # Load multichar file if there is one
+    if multichar_file != '':
+        with open(multichar_file, 'rb') as f:
+            multichars = json.load(f)
+    else:
+        multichars = {}
+
     # Load previously done decodings if any
-    prev_decodings = dict()   
-    if use_existing_decodings == True:
+    if memo_max_entries is not None or memo_max_bytes is not None:
+        prev_decodings = decoder.DecodingMemo(memo_max_entries, memo_max_bytes, memo_policy)
+    else:
+        prev_decodings = dict()   
+    if use_existing_decodings == True and args.cache == '':
         for filename in os.listdir(dir_decodings):
+            if not filename.endswith('.csv'):
+                continue
             for line in decoder.load_csv_unicode(os.path.join(dir_decodings, filename))[1:]:
                 prev_decodings[line[0]] = line[1:]
 
     # Load the rest of the parameters and create the decoder
-    dec = decoder.Decoder(decoder.load_hmm(hmm_params),
-                          decoder.load_dictionary(dict_file),
-                          prev_decodings)
+    word_dict = decoder.load_dictionary(dict_file)
+    if use_lexicon_decoding:
+        lexicon = decoder.LexiconTrie(word_dict)
+    else:
+        lexicon = None
+    hmm = decoder.load_hmm(hmm_params, use_log_probabilities)
+    hmm.set_emission_floor(emission_floor)
+    hmm.set_pruning(prune_ratio, beam_budget, audit_pruning)
+    dec = decoder.Decoder(hmm,
+                          word_dict,
+                          prev_decodings,
+                          output_linear_probabilities,
+                          lexicon,
+                          lexicon_width,
+                          multichar_engine,
+                          lattice_width,
+                          decoding_engine,
+                          fast_path_min_emission)
 
-    words = decoder.load_text(args.input_file, num_header_lines)
-    decoded_words = []
-    
-    # Load multichar file if there is one
-    if multichar_file != '':
-        with open(multichar_file, 'rb') as f:
-            multichars = json.load(f)
+    if args.cache != '':
+        dec.prev_decodings = decoder.DecodingCache(args.cache, dec.fingerprint(kn, multichars))
+        if args.purge_cache or purge_decoding_cache:
+            dec.prev_decodings.purge()
+
+    # Scores written for the newline placeholders
+    if dec.log_output:
+        certain, impossible = 0.0, float('-inf')
     else:
-        multichars = {}
+        certain, impossible = 1.0, 0.0
 
     # Newline characters are kept to recreate the text later, but are not passed to the decoder
     # They are replaced by labeled strings for writing to csv
-    for word in words:
-        if word == '\n':
-            decoded_words.append(['_NEWLINE_N_', '_NEWLINE_N_', 1.0] + ['_NEWLINE_N_', 0.0] * (kn-1))
-        elif word == '\r':
-            decoded_words.append(['_NEWLINE_R_', '_NEWLINE_R_', 1.0] + ['_NEWLINE_R_', 0.0] * (kn-1))
-        else:
-            decoded_words.append(dec.decode_word(word, kn, multichars))
+    newlines = {'\n': ['_NEWLINE_N_', '_NEWLINE_N_', certain] + ['_NEWLINE_N_', impossible] * (kn-1),
+                '\r': ['_NEWLINE_R_', '_NEWLINE_R_', certain] + ['_NEWLINE_R_', impossible] * (kn-1)}
+
+    filenames = input_files(args.input_file)
+
+    if args.vocabulary or decode_by_vocabulary or args.processes > 1:
+        counts = vocabulary(filenames)
+        print 'Found {} tokens of {} types in {} file(s)'.format(
+            sum(counts.itervalues()), len(counts), len(filenames))
+        decodings = decode_vocabulary(dec, counts, multichars, args.processes)
+        decodings.update(newlines)
+        for filename in filenames:
+            write_decodings(filename, (decodings[word] for word in
+                                       decoder.iter_text(filename, num_header_lines)))
+    else:
+        for filename in filenames:
+            write_decodings(filename, (newlines[word] if word in newlines
+                                       else dec.decode_word(word, kn, multichars)
+                                       for word in decoder.iter_text(filename, num_header_lines)))
+
+    if isinstance(dec.prev_decodings, decoder.DecodingMemo):
+        print 'Decoding memo: {entries} entries, {bytes} bytes, {hits} hits, {misses} misses, {evictions} evictions'.format(
+            **dec.prev_decodings.stats())
+
+    if dec.hmm.stats['beam_steps_saved'] > 0:
+        print 'Beam steps: {} computed, {} saved by shared prefixes'.format(
+            dec.hmm.stats['beam_steps'], dec.hmm.stats['beam_steps_saved'])
 
-    output_file = os.path.splitext(os.path.basename(args.input_file))[0] + '_decoded.csv'
+    if dec.hmm.emitting_states is not None:
+        print 'Beam steps: {} over emitting states only, {} over all states'.format(
+            dec.hmm.stats['sparse_steps'], dec.hmm.stats['dense_steps'])
 
+    if dec.fast_path is not None:
+        print 'Fast path: {} words decoded without a search'.format(dec.hmm.stats['fast_path_words'])
 
-    with open(os.path.join(dir_decodings,output_file), 'wb') as f:
-        writer = decoder.UnicodeWriter(f, dialect=csv.excel_tab, quoting=csv.QUOTE_NONE, quotechar=None)
-        writer.writerows(decoded_words)
+    if dec.hmm.prune_ratio is not None or dec.hmm.beam_budget is not None:
+        print 'Pruning: {} paths dropped, {} steps over budget'.format(
+            dec.hmm.stats['pruned_paths'], dec.hmm.stats['budget_steps'])
+        if dec.hmm.prune_audit:
+            print 'Pruning changed the k-best decodings of {} of {} tokens'.format(
+                dec.hmm.stats['pruning_changed'], dec.hmm.stats['audited_tokens'])
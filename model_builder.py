@@ -2,6 +2,9 @@ import collections
 import json
 import os
 
+import decoder
+import stores
+
 
 
 # - - - Defaults - - -
@@ -14,9 +17,14 @@ remove_chars = [' ', '\t', '\n', '\r', u'\ufeff']
 add_chars='resources/additional_characters.txt'
 sourcedir_hmm = 'train/HMMtrain/'
 sourcedir_gold = 'train/parallelSource/'
+# SQLite count store written by aligner.py. If set, the counts of every
+# document in it are used instead of sourcedir_hmm and the gold files.
+count_store = ''
 
 # Output
 hmm_params = 'resources/hmm_parameters.txt'
+# Binary copy of the parameters for fast, memory-mapped loading ('' to skip)
+hmm_params_binary = 'resources/hmm_parameters.bin'
 
 #-------------------------------------
 
@@ -40,6 +48,12 @@ def load_misread_counts(file_list, remove=[]):
             for i in counts:
                 confusion[i].update(counts[i])
 
+    return clean_misread_counts(confusion, remove)
+
+
+# Remove any keys which are not single characters, and the specified
+# characters, from combined misread counts.
+def clean_misread_counts(confusion, remove=[]):
     # Strip out any outer keys that aren't a single character
     confusion = {key:value for key, value in confusion.iteritems()
                  if len(key) == 1}
@@ -70,6 +84,10 @@ def text_char_counts(file_list, remove=[], header=0):
         c = collections.Counter(''.join(text))
         char_count.update(c)
 
+    return clean_char_counts(char_count, remove)
+
+
+def clean_char_counts(char_count, remove=[]):
     for unwanted in remove:
         if unwanted in char_count:
             del char_count[unwanted]
@@ -125,10 +143,9 @@ def emission_probabilities(confusion, char_counts, alpha,
     return confusion
     
     
-# Create the initial and transition probabilities from the corrected
-# text in the training data.
-def init_tran_probabilities(file_list, alpha,
-                            remove=[], header=0, char_file=None):
+# Count the word-initial characters and the character pairs within words
+# in the corrected text of the training data.
+def init_tran_counts(file_list, header=0):
     tran = collections.defaultdict(lambda: collections.defaultdict(int))
     init = collections.defaultdict(int)
     
@@ -143,6 +160,13 @@ def init_tran_probabilities(file_list, alpha,
                     for i in xrange(len(word)-1):
                         tran[word[i]][word[i+1]] += 1
 
+    return init, tran
+
+
+# Create the initial and transition probabilities from the counts of
+# init_tran_counts.
+def init_tran_probabilities(init, tran, alpha,
+                            remove=[], char_file=None):
     # Create a set of all the characters that have been seen.
     charset = set(tran.keys())
     charset.update(set(init.keys()))
@@ -200,26 +224,37 @@ def parameter_check(init, tran, emis):
 
 #-------------------------------------
 
-# Select the gold files which correspond to the misread count files.
-gold_files = []
-misread_files = []
-for filename in os.listdir(sourcedir_hmm):
-    misread_files.append(filename)
-    # [:-10] is to remove '_misread_counts' from the filename
-    gold_files.append('c_' + os.path.splitext(filename)[0][:-15] + '.txt')
-
-confusion = load_misread_counts(misread_files, remove_chars)
-char_counts = text_char_counts(gold_files, remove_chars, num_header_lines)
+if count_store != '':
+    # All the counts, read from the store in one query
+    store = stores.CountStore(count_store)
+    print 'Reading the counts of {} documents from {}'.format(len(store.documents()), count_store)
+    confusion, char_counts, init_counts, tran_counts = store.totals()
+    confusion = clean_misread_counts(confusion, remove_chars)
+    char_counts = clean_char_counts(char_counts, remove_chars)
+else:
+    # Select the gold files which correspond to the misread count files.
+    gold_files = []
+    misread_files = []
+    for filename in os.listdir(sourcedir_hmm):
+        misread_files.append(filename)
+        # [:-10] is to remove '_misread_counts' from the filename
+        gold_files.append('c_' + os.path.splitext(filename)[0][:-15] + '.txt')
+
+    confusion = load_misread_counts(misread_files, remove_chars)
+    char_counts = text_char_counts(gold_files, remove_chars, num_header_lines)
+    init_counts, tran_counts = init_tran_counts(gold_files, num_header_lines)
 
 # Create the emission probabilities from the misread counts and the character counts
 emis = emission_probabilities(confusion, char_counts, smoothing_parameter, remove_chars, 
                               char_file=add_chars)
 
 # Create the initial and transition probabilities from the gold files
-init, tran = init_tran_probabilities(gold_files, smoothing_parameter,
-                                     remove_chars, num_header_lines, 
-                                     char_file=add_chars)
+init, tran = init_tran_probabilities(init_counts, tran_counts, smoothing_parameter,
+                                     remove_chars, char_file=add_chars)
 
 if parameter_check(init, tran, emis) == True:
     with open(hmm_params,'wb') as f:
         json.dump((init, tran, emis), f)
+    # Converted from the JSON file, so both files list the states in the same order
+    if hmm_params_binary != '':
+        decoder.convert_hmm(hmm_params, hmm_params_binary)
@@ -0,0 +1,93 @@
+import collections
+import os
+import sqlite3
+
+
+
+class SQLiteStore(object):
+    """
+    Base class of the tables kept in SQLite databases. The database can be
+    shared by several runs and processes at once. Subclasses give the
+    statement creating their table as schema.
+    """
+
+    schema = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = None
+        self.pid = None
+
+    def _db(self):
+        # Each process opens its own connection, since connections
+        # cannot be shared with forked workers.
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.filename, timeout=60,
+                                              isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(self.schema)
+            self.pid = os.getpid()
+        return self.connection
+
+
+
+class CountStore(SQLiteStore):
+    """
+    Character counts of aligned training documents, stored in a SQLite
+    database: how often each correct character was read as each other
+    string, how often each character occurs in the corrected text, and how
+    often each character starts a word and is followed by each other
+    character. Counts are kept per document, and updating a document
+    replaces its counts, so documents can be added or realigned one at a
+    time and the totals read back with a single query.
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS counts '
+              '(document TEXT, kind TEXT, first TEXT, second TEXT, count INTEGER, '
+              'PRIMARY KEY (document, kind, first, second))')
+
+    # misreads and transitions map a character to a dict of counts, chars
+    # and initials map a character to its count.
+    def update(self, document, misreads, chars, initials, transitions):
+        rows = []
+        for kind, counts in (('misread', misreads), ('transition', transitions)):
+            for first in counts:
+                rows.extend((document, kind, first, second, count)
+                            for second, count in counts[first].iteritems())
+        for kind, counts in (('char', chars), ('initial', initials)):
+            rows.extend((document, kind, first, u'', count)
+                        for first, count in counts.iteritems())
+
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM counts WHERE document = ?', (document,))
+            db.executemany('INSERT INTO counts VALUES (?, ?, ?, ?, ?)', rows)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def remove(self, document):
+        self._db().execute('DELETE FROM counts WHERE document = ?', (document,))
+
+    def documents(self):
+        return [row[0] for row in self._db().execute('SELECT DISTINCT document FROM counts ORDER BY document')]
+
+    # The counts of all the documents added up, as (misreads, chars,
+    # initials, transitions) in the same form as for update().
+    def totals(self):
+        misreads = collections.defaultdict(collections.Counter)
+        transitions = collections.defaultdict(collections.Counter)
+        chars = collections.Counter()
+        initials = collections.Counter()
+        pairs = {'misread': misreads, 'transition': transitions}
+        singles = {'char': chars, 'initial': initials}
+        for kind, first, second, count in self._db().execute(
+                'SELECT kind, first, second, SUM(count) FROM counts GROUP BY kind, first, second'):
+            if kind in pairs:
+                pairs[kind][first][second] = count
+            else:
+                singles[kind][first] = count
+        return misreads, chars, initials, transitions
@@ -0,0 +1,43 @@
+import random
+import unittest
+
+import aligner
+
+
+
+class WordAnchoredTest(unittest.TestCase):
+
+    def assertSameErrors(self, gold, original):
+        self.assertEqual(aligner.align(gold, original, engine='words').errors,
+                         aligner.align(gold, original, engine='banded').errors)
+
+    def test_insertion_after_last_anchor(self):
+        # The only anchor, 'sat', ends s1, so the last span has text on the
+        # original side only.
+        self.assertSameErrors(u'ran dog ran cat sat',
+                              u'on far dog far sat a quux in lorem zebra away away a dog cat far zebra')
+
+    def test_insertion_at_end(self):
+        self.assertEqual(aligner.align(u'e', u'el', engine='words').errors, [['', u'l', 0, 0]])
+
+    def test_unbalanced_ends(self):
+        # Misread words, with extra words before or after the text on
+        # either side
+        rng = random.Random(1)
+        vocab = u'ran dog cat sat on far a quux in lorem zebra away the of and'.split()
+        for _ in xrange(100):
+            words = [rng.choice(vocab) + unicode(rng.randint(0, 50)) for _ in xrange(rng.randint(1, 30))]
+            noisy = [w if rng.random() > 0.2 else w[:-1] + u'x' for w in words]
+            extra = [rng.choice(vocab) for _ in xrange(rng.randint(1, 8))]
+            end = rng.choice(['original tail', 'original head', 'gold tail'])
+            if end == 'original tail':
+                noisy = noisy + extra
+            elif end == 'original head':
+                noisy = extra + noisy
+            else:
+                words = words + extra
+            self.assertSameErrors(u' '.join(words), u' '.join(noisy))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+import decoder
+
+
+
+def noisy_hmm(chars):
+    # Every state emits its own character with probability 0.8
+    n = len(chars)
+    init = {c:1.0 / n for c in chars}
+    tran = {c:{d:1.0 / n for d in chars} for c in chars}
+    emis = {c:{d:0.8 if c == d else 0.2 / (n - 1) for d in chars} for c in chars}
+    return decoder.HMM(init, tran, emis)
+
+
+class LexiconTrieTest(unittest.TestCase):
+
+    def test_capitalised_words(self):
+        # As in the dictionary check: a capital letter followed by a lower
+        # case entry in any case
+        lexicon = decoder.LexiconTrie([u'the', u'Cab', u'iPod'])
+        for word in [u'the', u'The', u'THE', u'ThE', u'Cab']:
+            self.assertIn(word, lexicon)
+        for word in [u'tHE', u'CAB', u'cab', u'IPod', u'IPOD']:
+            self.assertNotIn(word, lexicon)
+
+    def test_all_caps_token(self):
+        hmm = noisy_hmm(u'theTHE')
+        lexicon = decoder.LexiconTrie([u'the'])
+        self.assertEqual(hmm.k_best_lexicon(u'THE', 1, lexicon)[0][0], u'THE')
+        self.assertEqual(hmm.k_best_lexicon(u'THE', 1, lexicon, None)[0][0], u'THE')
+
+    def test_no_usable_words(self):
+        for words in [[], [u"don't"]]:
+            lexicon = decoder.LexiconTrie(words)
+            self.assertEqual(noisy_hmm(u'ab').k_best_lexicon(u'ab', 1, lexicon), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
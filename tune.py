@@ -8,6 +8,7 @@ caseSens = True
 kn = 4
 csvdir = 'train/devDecoded'
 outfile = 'resources/report.txt'
+columnar = False
 
 # runtime user input
 parser = argparse.ArgumentParser()
@@ -16,6 +17,7 @@ parser.add_argument("-c", help="case sensitivity, y/n (default y)")
 parser.add_argument("-k", help="number of decoded candidates in input, default 4")
 parser.add_argument("-v", help="path for directory of decoding CSVs")
 parser.add_argument("-o", help="output file name")
+parser.add_argument("-b", help="read columnar decodings (.bin, converted with convert_decodings.py --words 2) instead of CSVs, y/n (default n)")
 
 # ------------------------------------------
 # set up
@@ -45,6 +47,17 @@ if args.v:
         csvdir = args.v
 if args.o:
     outfile = args.o
+if args.b:
+    if args.b in ['y','Y','yes','Yes']:
+        columnar = True
+    elif args.b in ['n','N','no','No']:
+        columnar = False
+    else:
+        print("uninterpretable columnar specification!  : " + '"' + args.b + '"')
+        exit()
+# Only the columnar format needs the decoder module (and numpy)
+if columnar:
+    import decoder
 
 dictfilepre = codecs.open(dictfilename, 'r', 'utf-8')
 dictfile = dictfilepre.readlines()
@@ -125,6 +138,20 @@ def basicDictCheck(wd):
 
 
 
+#-------------------------------------
+# punctuation stripping
+# - - - 
+
+# forms already stripped of punctuation - filled in advance from columnar decodings
+stripcache = {}
+
+def stripp(wd):
+    if wd not in stripcache:
+        stripcache[wd] = regex.sub(ur"\p{P}+", "", wd)
+    return stripcache[wd]
+
+
+
 #-------------------------------------
 # measure
 # - - - 
@@ -132,17 +159,16 @@ def basicDictCheck(wd):
 # variables to track - see output file for interpretation
 vs = [0]*35
 
-# handle one token.
-def codeline(i,ln):
+# handle one token, given as the list of its fields.
+def codeline(i,l):
     global vs
     if not(caseSens):
-        ln = ln.lower()
-    l = ln.replace(u'\r\n','').split('\t')
+        l = [x.lower() if isinstance(x, unicode) else x for x in l]
 
 
     # strip punctuation, which is considered not relevant to evaluation
-    gold = regex.sub(ur"\p{P}+", "", l[0]) # gold standard wordform
-    orig = regex.sub(ur"\p{P}+", "", l[1]) # original uncorrected wordform
+    gold = stripp(l[0]) # gold standard wordform
+    orig = stripp(l[1]) # original uncorrected wordform
 
     
     # if the 1st or 2nd input column is empty, a word segmentation error probably occurred in the original
@@ -165,7 +191,7 @@ def codeline(i,ln):
 
 
     # k best candidate words
-    kbws = [ regex.sub(ur"\p{P}+", "", l[ix]) for ix in range(2,(kn*2)+1,2)]
+    kbws = [ stripp(l[ix]) for ix in range(2,(kn*2)+1,2)]
 
     # accompanying probabilities, if wanted
     #kbprobs = [ l[ix] for ix in range(3,(kn*2)+2,2)]
@@ -370,10 +396,18 @@ def codeline(i,ln):
 # gather stats on devset
 # - - -
 
-# read in csv data
-fnames = glob.glob(csvdir + '/*.csv')
-lns1 = [codecs.open(fn, 'r', 'utf-8').readlines()[1:] for fn in fnames]
-lns = [val for sublist in lns1 for val in sublist]
+# read in csv data, split into fields
+if columnar:
+    fnames = glob.glob(csvdir + '/*.bin')
+    lns = []
+    for fn in fnames:
+        decs = decoder.load_decodings_binary(fn)
+        stripcache.update(decs.stripped_forms())
+        lns.extend(list(decs.rows())[1:])
+else:
+    fnames = glob.glob(csvdir + '/*.csv')
+    lns1 = [codecs.open(fn, 'r', 'utf-8').readlines()[1:] for fn in fnames]
+    lns = [val.replace(u'\r\n','').split('\t') for sublist in lns1 for val in sublist]
 
 # sort each token
 for (i, lin) in enumerate(lns):